@@ -1,9 +1,11 @@
+import importlib.util
 import os
 import platform
 import subprocess
 import sys
 
 import bpy
+from bpy.app.handlers import persistent
 from bpy.utils import register_class, unregister_class
 
 # Addon metadata
@@ -50,10 +52,9 @@ def install_package(package):
 
 
 for package_py, package_pip in packages.items():
-    try:
-        exec("import " + package_py)
-
-    except ModuleNotFoundError:
+    # Only check that packages are installed, importing them all (whisper
+    # imports torch) would slow down every start of Blender
+    if importlib.util.find_spec(package_py) == None:
         print(
             package_py
             + " module not found, installing '"
@@ -71,12 +72,20 @@ print("All packages installed")
 # Load addon modules
 from .reachy_marionette import ReachyMarionette
 from .reachy_gpt import ReachyGPT
+from .reachy_intent import INTENTS
+from .reachy_tts import EspeakEngine, GTTSEngine
 from .reachy_voice import ReachyVoice
 
 # Global objects
 reachy = ReachyMarionette()
 reachy_gpt = ReachyGPT()
-reachy_voice = ReachyVoice()
+reachy_voice = ReachyVoice(
+    bpy.utils.user_resource("DATAFILES", path="reachy_marionette/tts", create=True)
+)
+
+# Reachy gestures along with its speech
+reachy_voice.tts.prepare_sentence = reachy.gestures.prepare
+reachy_voice.tts.on_sentence = reachy.gestures.play
 
 # Global constants
 AUDIO_FILE_PATH = "//mic_input.wav"
@@ -85,6 +94,129 @@ AUDIO_FILE_PATH = "//mic_input.wav"
 # Classes
 
 
+def redraw_panels(context):
+    # Panels are only redrawn on events, so progress must be pushed
+
+    for area in context.screen.areas:
+        if area.type == "VIEW_3D":
+            area.tag_redraw()
+
+
+def redraw_all_panels():
+    # Like redraw_panels, for timers where context has no screen
+
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "VIEW_3D":
+                area.tag_redraw()
+
+
+def redraw_animation_progress():
+    # Timer keeping animation progress up to date, while not in a modal operator
+
+    redraw_all_panels()
+
+    return 0.1 if reachy.player.is_playing() else None
+
+
+def redraw_whisper_status():
+    # Timer showing when the Whisper model is done loading
+
+    redraw_all_panels()
+
+    return 0.5 if reachy_voice.is_model_loading() else None
+
+
+def redraw_request_status():
+    # Timer showing when a cancelled request has returned
+
+    redraw_all_panels()
+
+    return 0.2 if reachy_gpt.is_request_pending() else None
+
+
+def load_whisper_model(scene_properties):
+    # Load model in the background, speech promts need it
+
+    reachy_voice.load_model(scene_properties.WhisperModel)
+
+    if reachy_voice.is_model_loading() and not bpy.app.timers.is_registered(
+        redraw_whisper_status
+    ):
+        bpy.app.timers.register(redraw_whisper_status, first_interval=0.5)
+
+
+def presynthesize_answers(scene_properties):
+    # Synthesize canned answers in the background, so they play right away
+
+    if not scene_properties.Speaker:
+        return
+
+    engine = {"gTTS": GTTSEngine, "eSpeak": EspeakEngine}[scene_properties.TTSEngine]
+
+    if reachy_voice.tts.engine.name != scene_properties.TTSEngine:
+        reachy_voice.tts.engine = engine()
+
+    if not reachy_voice.tts.engine.is_available():
+        print("Text to speech engine not available: " + scene_properties.TTSEngine)
+        return
+
+    answers = list(dict.fromkeys(intent["answer"] for intent in INTENTS))
+    reachy_voice.tts.presynthesize(answers, language="da")
+
+
+def report_deferred(report_type, message):
+    # Report from timers and threads' callbacks, where no operator is running
+    bpy.ops.reachy_marionette.report(
+        report_type=next(iter(report_type)), message=message
+    )
+
+
+def animation_rate(scene_properties):
+    # Rate to bake actions at, None samples them at their keyframes
+
+    if scene_properties.AnimationSampling == "Rate":
+        return scene_properties.StreamRate
+
+    return None
+
+
+def send_promt(promt, scene_properties):
+    # Send promt to ChatGPT, response is handled by on_gpt_response
+
+    reachy_gpt.animation_rate = animation_rate(scene_properties)
+    reachy_gpt.memory.token_budget = scene_properties.ChatTokenBudget
+    reachy_gpt.memory.summary_budget = scene_properties.ChatTokenBudget // 4
+    reachy_gpt.use_intents = scene_properties.UseLocalIntents
+    reachy_gpt.intents.confidence = scene_properties.IntentConfidence
+    reachy_gpt.use_cache = scene_properties.UseResponseCache
+    reachy_gpt.cache.similarity = scene_properties.CacheSimilarity
+
+    return reachy_gpt.send_request_async(
+        promt,
+        reachy,
+        report_deferred,
+        on_gpt_response,
+        timeout=scene_properties.RequestTimeout,
+        stream=scene_properties.StreamResponse,
+    )
+
+
+def on_gpt_response(response):
+    # Called on main thread, once ChatGPT's response has been handled
+    scene_properties = bpy.context.scene.scn_prop
+
+    redraw_all_panels()
+
+    if reachy.player.is_playing() and not bpy.app.timers.is_registered(
+        redraw_animation_progress
+    ):
+        bpy.app.timers.register(redraw_animation_progress)
+
+    if scene_properties.Speaker:
+        reachy_voice.speak_audio(response["answer"], language="da")
+
+
 class SceneProperties(bpy.types.PropertyGroup):
     # Defining custom properties to be used by the addon panel
 
@@ -111,6 +243,23 @@ class SceneProperties(bpy.types.PropertyGroup):
 
         return
 
+    def callback_whisper(self, context):
+
+        if self.PromtType == "Speech":
+            load_whisper_model(self)
+
+        return
+
+    def callback_gestures(self, context):
+        reachy.gestures.enabled = self.SpeechGestures
+
+        return
+
+    def callback_speaker(self, context):
+        presynthesize_answers(self)
+
+        return
+
     def callback_recording(self, context):
 
         if self.Recording:
@@ -124,6 +273,13 @@ class SceneProperties(bpy.types.PropertyGroup):
         default="localhost",
     )  # type: ignore (stops warning squiggles)
 
+    MappingFile: bpy.props.StringProperty(
+        name="Joint mapping",
+        description="JSON table mapping rig bones to Reachy joints (empty = default Reachy 2021 mapping).",
+        default="",
+        subtype="FILE_PATH",
+    )  # type: ignore (stops warning squiggles)
+
     Kinematics: bpy.props.EnumProperty(
         name="Kinematics",
         description="Choose if rig is controlled by forward kinematics (FK) or inverse kinematics (IK).",
@@ -138,9 +294,55 @@ class SceneProperties(bpy.types.PropertyGroup):
         update=callback_streaming,
     )  # type: ignore (stops warning squiggles)
 
+    StreamMode: bpy.props.EnumProperty(
+        name="Stream Mode",
+        description="Stream on a fixed timer, or only when the pose of the rig changes.",
+        items=[("Timer", "Timer", ""), ("Event", "Event", "")],
+        default="Timer",
+    )  # type: ignore (stops warning squiggles)
+
+    StreamRate: bpy.props.IntProperty(
+        name="Rate",
+        description="How many times per second angles are streamed to Reachy, at most (Hz).",
+        default=30,
+        min=1,
+        max=100,
+    )  # type: ignore (stops warning squiggles)
+
+    Deadband: bpy.props.FloatProperty(
+        name="Deadband",
+        description="Joints that moved less than this many degrees since last sent are not sent again.",
+        default=0.5,
+        min=0.0,
+        max=10.0,
+    )  # type: ignore (stops warning squiggles)
+
+    AnimationSampling: bpy.props.EnumProperty(
+        name="Animation Sampling",
+        description="Send animation at every keyframe, or sampled at the stream rate.",
+        items=[("Keyframes", "Keyframes", ""), ("Rate", "Rate", "")],
+        default="Keyframes",
+    )  # type: ignore (stops warning squiggles)
+
     Speaker: bpy.props.BoolProperty(
         description="If responses from ChatGPT are played through speaker.",
         default=False,
+        update=callback_speaker,
+    )  # type: ignore (stops warning squiggles)
+
+    SpeechGestures: bpy.props.BoolProperty(
+        name="Gestures",
+        description="Move Reachy's arms along with the loudness of its speech.",
+        default=True,
+        update=callback_gestures,
+    )  # type: ignore (stops warning squiggles)
+
+    TTSEngine: bpy.props.EnumProperty(
+        name="Voice",
+        description="Text to speech engine, gTTS needs network, eSpeak NG runs offline but must be installed.",
+        items=[("gTTS", "gTTS", ""), ("eSpeak", "eSpeak", "")],
+        default="gTTS",
+        update=callback_speaker,
     )  # type: ignore (stops warning squiggles)
 
     PromtType: bpy.props.EnumProperty(
@@ -148,12 +350,126 @@ class SceneProperties(bpy.types.PropertyGroup):
         description="Choose if promt is provided as text or speech.",
         items=[("Text", "Text", ""), ("Speech", "Speech", "")],
         default="Text",
+        update=callback_whisper,
+    )  # type: ignore (stops warning squiggles)
+
+    WhisperModel: bpy.props.EnumProperty(
+        name="Whisper Model",
+        description="Size of the speech recognition model, larger is more accurate but slower to load and run.",
+        items=[
+            ("tiny", "Tiny", ""),
+            ("base", "Base", ""),
+            ("small", "Small", ""),
+            ("medium", "Medium", ""),
+            ("large", "Large", ""),
+        ],
+        default="small",
+        update=callback_whisper,
     )  # type: ignore (stops warning squiggles)
 
     Promt: bpy.props.StringProperty(
         name="Promt", description="Promt for ChatGPT", default=""
     )  # type: ignore (stops warning squiggles)
 
+    LLMBackend: bpy.props.EnumProperty(
+        name="Backend",
+        description="OpenAI, an OpenAI compatible endpoint (like an on-prem model), or a local mock server for testing without network.",
+        items=[
+            ("OpenAI", "OpenAI", ""),
+            ("Custom", "Custom", ""),
+            ("Mock", "Mock", ""),
+        ],
+        default="OpenAI",
+    )  # type: ignore (stops warning squiggles)
+
+    LLMBaseURL: bpy.props.StringProperty(
+        name="Base URL",
+        description="Base URL of the OpenAI compatible endpoint, like http://localhost:8000/v1",
+        default="http://localhost:8000/v1",
+    )  # type: ignore (stops warning squiggles)
+
+    LLMModel: bpy.props.StringProperty(
+        name="Model",
+        description="Name of the model to request completions from.",
+        default="gpt-4o",
+    )  # type: ignore (stops warning squiggles)
+
+    RequestTimeout: bpy.props.FloatProperty(
+        name="Timeout",
+        description="Seconds to wait for a response from ChatGPT.",
+        default=20.0,
+        min=1.0,
+        max=120.0,
+    )  # type: ignore (stops warning squiggles)
+
+    StreamResponse: bpy.props.BoolProperty(
+        name="Stream Response",
+        description="Stream responses from ChatGPT, starting the action before the answer is complete.",
+        default=True,
+    )  # type: ignore (stops warning squiggles)
+
+    ChatTokenBudget: bpy.props.IntProperty(
+        name="Chat Memory",
+        description="Tokens of earlier conversation sent with each promt, older messages are summarized.",
+        default=800,
+        min=100,
+        max=8000,
+    )  # type: ignore (stops warning squiggles)
+
+    UseLocalIntents: bpy.props.BoolProperty(
+        name="Local Intents",
+        description="Answer obvious promts (greetings, yes / no, dance) locally, without ChatGPT.",
+        default=True,
+    )  # type: ignore (stops warning squiggles)
+
+    IntentConfidence: bpy.props.FloatProperty(
+        name="Confidence",
+        description="How confident the local intent must be to skip ChatGPT.",
+        default=0.75,
+        min=0.0,
+        max=1.0,
+    )  # type: ignore (stops warning squiggles)
+
+    UseResponseCache: bpy.props.BoolProperty(
+        name="Cache Responses",
+        description="Reuse responses to promts that have been sent before in the same context.",
+        default=True,
+    )  # type: ignore (stops warning squiggles)
+
+    CacheSimilarity: bpy.props.FloatProperty(
+        name="Similarity",
+        description="How similar a promt must be to a cached one to reuse its response (1.0 = only identical promts).",
+        default=1.0,
+        min=0.5,
+        max=1.0,
+    )  # type: ignore (stops warning squiggles)
+
+    SaveRecording: bpy.props.BoolProperty(
+        name="Save Recording",
+        description="Also save recordings to mic_input.wav next to the .blend file, for debugging.",
+        default=False,
+    )  # type: ignore (stops warning squiggles)
+
+    AutoStopRecording: bpy.props.BoolProperty(
+        name="Auto Stop",
+        description="Stop recording by itself after a pause in speech.",
+        default=True,
+    )  # type: ignore (stops warning squiggles)
+
+    SilenceDuration: bpy.props.FloatProperty(
+        name="Pause",
+        description="Seconds of silence after speech that stop the recording.",
+        default=0.8,
+        min=0.2,
+        max=3.0,
+    )  # type: ignore (stops warning squiggles)
+
+    StreamTranscription: bpy.props.BoolProperty(
+        name="Transcribe While Speaking",
+        description="Transcribe speech in overlapping chunks while recording, so less is left to transcribe when speech ends.",
+        default=False,
+    )  # type: ignore (stops warning squiggles)
+
     Recording: bpy.props.BoolProperty(
         description="If addon is currently recording audio.",
         default=False,
@@ -169,7 +485,11 @@ class REACHYMARIONETTE_OT_ConnectReachy(bpy.types.Operator):
     def execute(self, context):
         scene_properties = context.scene.scn_prop
 
-        reachy.connect_reachy(self.report, scene_properties.IPaddress)
+        reachy.connect_reachy(
+            self.report,
+            scene_properties.IPaddress,
+            bpy.path.abspath(scene_properties.MappingFile),
+        )
 
         return {"FINISHED"}
 
@@ -211,7 +531,7 @@ class REACHYMARIONETTE_OT_StreamPose(bpy.types.Operator):
     def __del__(self):
         reachy.set_state_idle()
 
-        print("Stream ended")
+        print("Stream ended: " + str(reachy.sender.stats()))
 
     def modal(self, context, event):
         scene_properties = context.scene.scn_prop
@@ -222,6 +542,12 @@ class REACHYMARIONETTE_OT_StreamPose(bpy.types.Operator):
 
         if event.type == "ESC":
             self.report({"INFO"}, "ESC key pressed, stopping stream")
+            scene_properties.Streaming = False
+            return {"FINISHED"}
+
+        if not reachy.is_streaming():
+            # Stopped by Reachy, for example when disconnected
+            scene_properties.Streaming = False
             return {"FINISHED"}
 
         return {"PASS_THROUGH"}
@@ -229,13 +555,20 @@ class REACHYMARIONETTE_OT_StreamPose(bpy.types.Operator):
     def invoke(self, context, event):
         context.window_manager.modal_handler_add(self)
 
-        reachy.stream_angles_enable(self.report)
+        scene_properties = context.scene.scn_prop
+
+        reachy.stream_angles_enable(
+            self.report,
+            scene_properties.StreamRate,
+            scene_properties.Deadband,
+            event_driven=scene_properties.StreamMode == "Event",
+        )
 
         return {"RUNNING_MODAL"}
 
 
 class REACHYMARIONETTE_OT_AnimatePose(bpy.types.Operator):
-    # Go through animation timeline and get angles from Blender rig, and send to Reachy
+    # Bake animation of Blender rig, and play it on Reachy in the background
 
     bl_idname = "reachy_marionette.animate_pose"
     bl_label = "Go through animation timeline and send poses"
@@ -246,23 +579,69 @@ class REACHYMARIONETTE_OT_AnimatePose(bpy.types.Operator):
     def __del__(self):
         print("Animation ended")
 
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        redraw_panels(context)
+
+        return {"FINISHED"}
+
     def modal(self, context, event):
         if event.type == "ESC":
             reachy.set_state_idle()
 
             self.report({"INFO"}, "ESC key pressed, stopping animation")
-            return {"FINISHED"}
+            return self.finish(context)
+
+        if event.type == "TIMER":
+            # Update progress in panel
+            redraw_panels(context)
+
+            if not reachy.player.is_playing():
+                return self.finish(context)
 
         return {"PASS_THROUGH"}
 
     def invoke(self, context, event):
-        context.window_manager.modal_handler_add(self)
+        scene_properties = context.scene.scn_prop
 
-        reachy.animate_angles(self.report)
+        if not reachy.animate_angles(self.report, animation_rate(scene_properties)):
+            return {"CANCELLED"}
+
+        self.timer = context.window_manager.event_timer_add(0.1, window=context.window)
+        context.window_manager.modal_handler_add(self)
 
         return {"RUNNING_MODAL"}
 
 
+class REACHYMARIONETTE_OT_PauseAnimation(bpy.types.Operator):
+    # Pause or resume animation playing on Reachy
+
+    bl_idname = "reachy_marionette.pause_animation"
+    bl_label = "Pause or resume animation"
+
+    def execute(self, context):
+
+        if reachy.player.is_paused():
+            reachy.resume_animation()
+        else:
+            reachy.pause_animation()
+
+        return {"FINISHED"}
+
+
+class REACHYMARIONETTE_OT_StopAnimation(bpy.types.Operator):
+    # Stop animation playing on Reachy, mid-motion
+
+    bl_idname = "reachy_marionette.stop_animation"
+    bl_label = "Stop animation"
+
+    def execute(self, context):
+
+        reachy.set_state_idle()
+
+        return {"FINISHED"}
+
+
 class REACHYMARIONETTE_OT_ActivateGPT(bpy.types.Operator):
 
     bl_idname = "reachy_marionette.activate_gpt"
@@ -271,7 +650,12 @@ class REACHYMARIONETTE_OT_ActivateGPT(bpy.types.Operator):
     def execute(self, context):
         scene_properties = context.scene.scn_prop
 
-        if not reachy_gpt.activate(self.report):
+        if not reachy_gpt.activate(
+            self.report,
+            scene_properties.LLMBackend,
+            scene_properties.LLMBaseURL,
+            scene_properties.LLMModel,
+        ):
             return {"CANCELLED"}
 
         return {"FINISHED"}
@@ -286,10 +670,61 @@ class REACHYMARIONETTE_OT_SendRequest(bpy.types.Operator):
     def execute(self, context):
         scene_properties = context.scene.scn_prop
 
-        response = reachy_gpt.send_request(scene_properties.Promt, reachy, self.report)
+        if not send_promt(scene_properties.Promt, scene_properties):
+            return {"CANCELLED"}
+
+        return {"FINISHED"}
+
+
+class REACHYMARIONETTE_OT_CancelRequest(bpy.types.Operator):
+    # Stop waiting for ChatGPT response
+
+    bl_idname = "reachy_marionette.cancel_request"
+    bl_label = "Cancel ChatGPT request"
+
+    def execute(self, context):
+
+        reachy_gpt.cancel_request()
+        self.report({"INFO"}, "ChatGPT request cancelled")
+
+        if not bpy.app.timers.is_registered(redraw_request_status):
+            bpy.app.timers.register(redraw_request_status)
+
+        return {"FINISHED"}
+
+
+class REACHYMARIONETTE_OT_ClearChat(bpy.types.Operator):
+    # Forget the conversation, for example when a new visitor arrives
 
-        if scene_properties.Speaker:
-            reachy_voice.speak_audio(response["answer"], language="da")
+    bl_idname = "reachy_marionette.clear_chat"
+    bl_label = "Clear chat memory"
+
+    def execute(self, context):
+
+        reachy_gpt.memory.clear()
+        self.report({"INFO"}, "Chat memory cleared")
+
+        return {"FINISHED"}
+
+
+class REACHYMARIONETTE_OT_Report(bpy.types.Operator):
+    # Reports messages to Blender for code not running in an operator
+
+    bl_idname = "reachy_marionette.report"
+    bl_label = "Report message"
+    bl_options = {"INTERNAL"}
+
+    report_type: bpy.props.StringProperty(
+        default="INFO"
+    )  # type: ignore (stops warning squiggles)
+
+    message: bpy.props.StringProperty(
+        default=""
+    )  # type: ignore (stops warning squiggles)
+
+    def execute(self, context):
+
+        self.report({self.report_type}, self.message)
 
         return {"FINISHED"}
 
@@ -306,54 +741,105 @@ class REACHYMARIONETTE_OT_RecordAudio(bpy.types.Operator):
     def __del__(self):
         print("Recording processed")
 
-    def process_recording(self, scene_properties):
+    def process_recording(self, context):
 
         reachy_voice.stop_recording()
         print("Recording ended")
 
-        audio_file_path = bpy.path.abspath(AUDIO_FILE_PATH)
+        if reachy_voice.is_model_loading():
+            # First recording after a lazy load, transcribed once it's ready.
+            # Audio is kept here, as a new recording replaces reachy_voice's
+            self.report({"INFO"}, "Waiting for Whisper model...")
+            self.audio = reachy_voice.audio
+            return {"RUNNING_MODAL"}
 
-        # Convert to text
-        transcription = reachy_voice.transcribe_audio(
-            audio_file_path, self.report, language="da"
-        )
+        # Convert to text, straight from the recorded buffer
+        transcription = reachy_voice.get_transcription(self.report, language="da")
+
+        return self.send_transcription(context, transcription)
+
+    def send_transcription(self, context, transcription):
+
+        if transcription != None:
+            # Send promt to ChatGPT
+            send_promt(transcription, context.scene.scn_prop)
 
-        # Send promt to ChatGPT
-        response = reachy_gpt.send_request(transcription, reachy, self.report)
+        return self.finish(context)
 
-        if scene_properties.Speaker:
-            reachy_voice.speak_audio(response["answer"], language="da")
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+
+        return {"FINISHED"}
 
     def modal(self, context, event):
         scene_properties = context.scene.scn_prop
 
+        if self.audio is not None:
+            # Recording has ended, waiting for the model to transcribe it
+            if event.type == "ESC":
+                self.report({"INFO"}, "ESC key pressed, recording discarded")
+                return self.finish(context)
+
+            if reachy_voice.is_model_loading():
+                return {"PASS_THROUGH"}
+
+            transcription = reachy_voice.transcribe_audio(
+                self.audio, self.report, language="da"
+            )
+            return self.send_transcription(context, transcription)
+
         # Sync settings
         if not reachy_voice.recording:
             scene_properties.Recording = False
-            self.process_recording(scene_properties)
-            return {"FINISHED"}
+            return self.process_recording(context)
 
         if not scene_properties.Recording:
             self.report({"INFO"}, "Stopping recording")
-            self.process_recording(scene_properties)
-            return {"FINISHED"}
+            return self.process_recording(context)
 
         if event.type == "ESC":
-            self.report({"INFO"}, "ESC key pressed, stopping recording and processing")
-            return {"FINISHED"}
+            self.report({"INFO"}, "ESC key pressed, recording discarded")
+            reachy_voice.cancel_recording()
+            scene_properties.Recording = False
+            return self.finish(context)
 
         return {"PASS_THROUGH"}
 
     def invoke(self, context, event):
         context.window_manager.modal_handler_add(self)
 
-        audio_file_path = bpy.path.abspath(AUDIO_FILE_PATH)
+        self.audio = None  # Recording waiting for the model, if any
+
+        # Model may not be loaded yet, if the file was saved in Speech mode
+        load_whisper_model(context.scene.scn_prop)
+
+        # Recordings are only written to file for debugging
+        audio_file_path = None
+        if context.scene.scn_prop.SaveRecording:
+            audio_file_path = bpy.path.abspath(AUDIO_FILE_PATH)
+
+        # Stop by itself after a pause in speech
+        silence_duration = None
+        if context.scene.scn_prop.AutoStopRecording:
+            silence_duration = context.scene.scn_prop.SilenceDuration
+
+        # Transcribe while recording, so less is left when speech ends
+        stream_language = None
+        if context.scene.scn_prop.StreamTranscription:
+            stream_language = "da"
 
         # Record audio sample
         reachy_voice.start_recording(
-            self.report, file_path=audio_file_path, duration_max=10.0
+            self.report,
+            file_path=audio_file_path,
+            duration_max=10.0,
+            silence_duration=silence_duration,
+            stream_language=stream_language,
         )
 
+        # Timer events, so the end of recording is noticed without user input
+        self.timer = context.window_manager.event_timer_add(0.1, window=context.window)
+
         return {"RUNNING_MODAL"}
 
 
@@ -371,8 +857,9 @@ class REACHYMARIONETTE_PT_PanelConnection(bpy.types.Panel):
         scene_properties = context.scene.scn_prop
 
         layout.prop(scene_properties, "IPaddress")
+        layout.prop(scene_properties, "MappingFile")
 
-        if reachy.reachy == None:
+        if not reachy.connection.is_wanted():
             layout.row().operator(
                 REACHYMARIONETTE_OT_ConnectReachy.bl_idname,
                 text="Connect to Reachy",
@@ -386,6 +873,9 @@ class REACHYMARIONETTE_PT_PanelConnection(bpy.types.Panel):
                 icon="UNLINKED",
             )
 
+            if not reachy.connection.is_alive():
+                layout.label(text=reachy.connection.status, icon="ERROR")
+
 
 class REACHYMARIONETTE_PT_PanelManual(bpy.types.Panel):
     # Addon panel displaying options
@@ -408,15 +898,42 @@ class REACHYMARIONETTE_PT_PanelManual(bpy.types.Panel):
             icon="ARMATURE_DATA",
         )
 
+        layout.prop(scene_properties, "StreamMode", expand=True)
+
         label = "Streaming..." if scene_properties.Streaming else "Stream Pose"
         icon = "RADIOBUT_ON" if scene_properties.Streaming else "RADIOBUT_OFF"
-        layout.prop(scene_properties, "Streaming", text=label, icon=icon, toggle=True)
+        row = layout.row()
+        row.prop(scene_properties, "Streaming", text=label, icon=icon, toggle=True)
+        row.prop(scene_properties, "StreamRate")
+        row.prop(scene_properties, "Deadband")
+
+        layout.prop(scene_properties, "AnimationSampling", expand=True)
+
+        if reachy.player.is_playing():
+            layout.progress(
+                factor=reachy.player.progress,
+                type="BAR",
+                text="Animating %d%%" % (reachy.player.progress * 100),
+            )
 
-        layout.row().operator(
-            REACHYMARIONETTE_OT_AnimatePose.bl_idname,
-            text="Animate Pose",
-            icon="PLAY",
-        )
+            row = layout.row()
+            row.operator(
+                REACHYMARIONETTE_OT_PauseAnimation.bl_idname,
+                text="Resume" if reachy.player.is_paused() else "Pause",
+                icon="PLAY" if reachy.player.is_paused() else "PAUSE",
+            )
+            row.operator(
+                REACHYMARIONETTE_OT_StopAnimation.bl_idname,
+                text="Stop",
+                icon="SNAP_FACE",
+            )
+
+        else:
+            layout.row().operator(
+                REACHYMARIONETTE_OT_AnimatePose.bl_idname,
+                text="Animate Pose",
+                icon="PLAY",
+            )
 
 
 class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
@@ -432,7 +949,15 @@ class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
         layout = self.layout
         scene_properties = context.scene.scn_prop
 
-        if reachy_gpt.client == None:
+        layout.prop(scene_properties, "LLMBackend", expand=True)
+
+        if scene_properties.LLMBackend == "Custom":
+            layout.prop(scene_properties, "LLMBaseURL")
+
+        if scene_properties.LLMBackend != "Mock":
+            layout.prop(scene_properties, "LLMModel")
+
+        if reachy_gpt.backend == None:
 
             layout.row().operator(
                 REACHYMARIONETTE_OT_ActivateGPT.bl_idname,
@@ -449,7 +974,26 @@ class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
 
         label = "Sound ON" if scene_properties.Speaker else "Sound OFF"
         icon = "MUTE_IPO_ON" if scene_properties.Speaker else "MUTE_IPO_OFF"
-        layout.prop(scene_properties, "Speaker", text=label, icon=icon, toggle=True)
+        row = layout.row()
+        row.prop(scene_properties, "Speaker", text=label, icon=icon, toggle=True)
+        row.prop(scene_properties, "TTSEngine", text="")
+        row.prop(scene_properties, "SpeechGestures", toggle=True)
+
+        layout.prop(scene_properties, "StreamResponse")
+
+        row = layout.row()
+        row.prop(scene_properties, "ChatTokenBudget")
+        row.operator(
+            REACHYMARIONETTE_OT_ClearChat.bl_idname, text="Clear", icon="TRASH"
+        )
+
+        row = layout.row()
+        row.prop(scene_properties, "UseLocalIntents")
+        row.prop(scene_properties, "IntentConfidence")
+
+        row = layout.row()
+        row.prop(scene_properties, "UseResponseCache")
+        row.prop(scene_properties, "CacheSimilarity")
 
         layout.prop(scene_properties, "PromtType", expand=True)
 
@@ -457,11 +1001,26 @@ class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
 
             layout.prop(scene_properties, "Promt")
 
-            layout.row().operator(
-                REACHYMARIONETTE_OT_SendRequest.bl_idname,
-                text="Send Request",
-                icon="URL",
-            )
+            if reachy_gpt.is_request_cancelled():
+                layout.label(text="Cancelling request...", icon="SORTTIME")
+
+            elif reachy_gpt.is_request_pending():
+                row = layout.row()
+                row.label(text="Waiting for response...", icon="SORTTIME")
+                row.operator(
+                    REACHYMARIONETTE_OT_CancelRequest.bl_idname,
+                    text="Cancel",
+                    icon="CANCEL",
+                )
+
+            else:
+                row = layout.row()
+                row.operator(
+                    REACHYMARIONETTE_OT_SendRequest.bl_idname,
+                    text="Send Request",
+                    icon="URL",
+                )
+                row.prop(scene_properties, "RequestTimeout")
 
         elif scene_properties.PromtType == "Speech":
 
@@ -471,6 +1030,19 @@ class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
             #     icon="SPEAKER",
             # )
 
+            row = layout.row()
+            row.prop(scene_properties, "WhisperModel", text="")
+            icon = {"Ready": "CHECKMARK", "Failed": "ERROR"}.get(
+                reachy_voice.model_status, "SORTTIME"
+            )
+            row.label(text=reachy_voice.model_status, icon=icon)
+            row.prop(scene_properties, "SaveRecording", text="", icon="FILE_SOUND")
+
+            row = layout.row()
+            row.prop(scene_properties, "AutoStopRecording")
+            row.prop(scene_properties, "SilenceDuration")
+            layout.prop(scene_properties, "StreamTranscription")
+
             label = "Recording..." if scene_properties.Recording else "Record Audio"
             icon = "RADIOBUT_ON" if scene_properties.Recording else "RADIOBUT_OFF"
             layout.prop(
@@ -478,6 +1050,20 @@ class REACHYMARIONETTE_PT_PanelAI(bpy.types.Panel):
             )
 
 
+@persistent
+def warm_trajectory_cache(*args):
+    # Bake ChatGPT actions of the open file and synthesize canned answers,
+    # so responses can start right away
+
+    scene_properties = bpy.context.scene.scn_prop
+
+    reachy.warm_trajectory_cache(
+        reachy_gpt.action_catalouge, animation_rate(scene_properties)
+    )
+
+    presynthesize_answers(scene_properties)
+
+
 classes = (
     SceneProperties,
     REACHYMARIONETTE_OT_ConnectReachy,
@@ -485,8 +1071,13 @@ classes = (
     REACHYMARIONETTE_OT_SendPose,
     REACHYMARIONETTE_OT_StreamPose,
     REACHYMARIONETTE_OT_AnimatePose,
+    REACHYMARIONETTE_OT_PauseAnimation,
+    REACHYMARIONETTE_OT_StopAnimation,
     REACHYMARIONETTE_OT_ActivateGPT,
     REACHYMARIONETTE_OT_SendRequest,
+    REACHYMARIONETTE_OT_CancelRequest,
+    REACHYMARIONETTE_OT_ClearChat,
+    REACHYMARIONETTE_OT_Report,
     REACHYMARIONETTE_OT_RecordAudio,
     REACHYMARIONETTE_PT_PanelConnection,
     REACHYMARIONETTE_PT_PanelManual,
@@ -500,6 +1091,10 @@ def register():
 
     bpy.types.Scene.scn_prop = bpy.props.PointerProperty(type=SceneProperties)
 
+    # Data is not available while registering, warm cache once it is
+    bpy.app.handlers.load_post.append(warm_trajectory_cache)
+    bpy.app.timers.register(warm_trajectory_cache, first_interval=1.0)
+
 
 def unregister():
     for cls in classes:
@@ -507,10 +1102,18 @@ def unregister():
 
     del bpy.types.Scene.scn_prop
 
+    if warm_trajectory_cache in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(warm_trajectory_cache)
+
     def temp(_x, _y): ...
 
     reachy.disconnect_reachy(temp)
 
+    if reachy_gpt.backend != None:
+        reachy_gpt.backend.close()
+
+    reachy_voice.tts.stop()
+
 
 if __name__ == "__main__":
 
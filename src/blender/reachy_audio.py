@@ -0,0 +1,73 @@
+import numpy as np
+import scipy.io.wavfile as wav
+
+
+def pcm_to_float32(data, sample_width, channels=1):
+    """Mono float32 samples in the range [-1, 1] from interleaved PCM data
+    (bytes, or any buffer like a NumPy array or pydub's raw_data). The data
+    is viewed in place, and only the float32 result is allocated (plus the
+    mixdown, for more than one channel).
+
+    sample_width: bytes per sample, 1 (unsigned), 2, 3 or 4 (signed)
+    """
+    if sample_width == 3:
+        # 24 bit has no NumPy type, widen to int32 (upper bytes, sign kept)
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        samples = np.zeros((len(raw), 4), dtype=np.uint8)
+        samples[:, 1:] = raw
+        samples = samples.view("<i4")[:, 0]
+        sample_width = 4
+
+    elif sample_width == 1:
+        samples = np.frombuffer(data, dtype=np.uint8)
+
+    else:
+        samples = np.frombuffer(data, dtype="<i%d" % sample_width)
+
+    offset = 128.0 if sample_width == 1 else 0.0
+    scale = np.float32(1.0 / 2 ** (8 * sample_width - 1))
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+
+    if offset != 0.0:
+        samples = np.subtract(samples, offset, dtype=np.float32)
+
+    return np.multiply(samples, scale, dtype=np.float32)
+
+
+def resample(audio, samplerate, samplerate_new):
+    # Band limited resampling by the FFT, no ffmpeg needed
+
+    if len(audio) == 0 or samplerate == samplerate_new:
+        return audio.astype(np.float32)
+
+    length = int(round(len(audio) * samplerate_new / samplerate))
+    spectrum = np.fft.rfft(audio)
+
+    # irfft truncates the spectrum to the new length's Nyquist frequency
+    audio_new = np.fft.irfft(spectrum, length) * (length / len(audio))
+
+    return audio_new.astype(np.float32)
+
+
+def read_wav(file_path, samplerate_new=None):
+    # Mono float32 samples and samplerate of a WAV file (path or file
+    # object), without ffmpeg. Files are memory mapped rather than read
+
+    samplerate, data = wav.read(file_path, mmap=isinstance(file_path, str))
+
+    channels = 1 if data.ndim == 1 else data.shape[1]
+
+    if data.dtype.kind == "f":
+        samples = data.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    else:
+        samples = pcm_to_float32(
+            np.ascontiguousarray(data), data.dtype.itemsize, channels
+        )
+
+    if samplerate_new != None:
+        samples = resample(samples, samplerate, samplerate_new)
+        samplerate = samplerate_new
+
+    return samples, samplerate
@@ -0,0 +1,217 @@
+from collections import OrderedDict
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import threading
+import time
+
+
+def atomic_write(file_path, write, suffix=".tmp"):
+    """Writes file_path by write(temp_path), then moves the temporary file in
+    place, so readers (or a crash while writing) never see a partial file.
+    suffix must keep the extension if write() adds a missing one (np.savez).
+    """
+    temp_path = file_path + suffix
+
+    write(temp_path)
+    os.replace(temp_path, file_path)
+
+
+class LRUCache:
+    """Least recently used cache with optional time to live (seconds).
+    Values must be JSON serializable if the cache is persisted to file_path.
+    """
+
+    def __init__(self, max_size=256, ttl=None, file_path=None):
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.file_path = file_path
+
+        self.entries = OrderedDict()  # key: (time added, value)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def is_expired(self, time_added):
+        return self.ttl != None and time.time() - time_added > self.ttl
+
+    def get(self, key):
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry == None:
+                return None
+
+            if self.is_expired(entry[0]):
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+
+            return entry[1]
+
+    def put(self, key, value):
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def items(self):
+        # Non expired (key, value) pairs, least recently used first
+
+        with self.lock:
+            return [
+                (key, value)
+                for key, (time_added, value) in self.entries.items()
+                if not self.is_expired(time_added)
+            ]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load(self):
+
+        if self.file_path == None or not os.path.exists(self.file_path):
+            return
+
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+
+        except (OSError, ValueError) as error:
+            print("Could not load cache '%s': %s" % (self.file_path, error))
+            return
+
+        with self.lock:
+            for key, (time_added, value) in entries:
+                if not self.is_expired(time_added):
+                    self.entries[key] = (time_added, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def save(self):
+
+        if self.file_path == None:
+            return
+
+        with self.lock:
+            entries = [
+                [key, [time_added, value]]
+                for key, (time_added, value) in self.entries.items()
+            ]
+
+        def write(file_path):
+            with open(file_path, "w", encoding="utf-8") as file:
+                json.dump(entries, file, ensure_ascii=False)
+
+        try:
+            atomic_write(self.file_path, write)
+
+        except OSError as error:
+            print("Could not save cache '%s': %s" % (self.file_path, error))
+
+
+def normalize_text(text):
+    # Lower case words without punctuation, "Hello,  Reachy!" -> "hello reachy"
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def embed_text(text, size=256):
+    """Local embedding of text, as a normalized vector of hashed character
+    trigram counts. Cheap, and good enough to find rephrasings of short
+    prompts like "hello there" and "hello".
+    """
+    text = " " + normalize_text(text) + " "
+    vector = np.zeros(size, dtype=np.float32)
+
+    for i in range(len(text) - 2):
+        digest = hashlib.md5(text[i : i + 3].encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % size] += 1.0
+
+    norm = np.linalg.norm(vector)
+
+    return vector / norm if norm > 0 else vector
+
+
+class ResponseCache:
+    """Cache of ChatGPT responses, with an exact tier keyed by the normalized
+    prompt plus chat context, and an optional similarity tier comparing
+    embeddings of prompts with the same chat context.
+    """
+
+    def __init__(self, file_path=None, max_size=256, ttl=7 * 24 * 3600):
+
+        self.cache = LRUCache(max_size, ttl, file_path)
+        self.cache.load()
+
+        self.similarity = 1.0  # Threshold of similarity tier, 1.0 disables it
+        self.embed = embed_text
+
+        self.hits = 0
+        self.misses = 0
+
+    def context_hash(self, context):
+        return hashlib.sha1(
+            json.dumps(context, sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def key(self, promt, context):
+        return self.context_hash(context) + ":" + normalize_text(promt)
+
+    def get(self, promt, context):
+
+        key = self.key(promt, context)
+        response = self.cache.get(key)
+
+        if response == None and self.similarity < 1.0:
+            response = self.get_similar(promt, key.split(":", 1)[0])
+
+        if response == None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return dict(response)
+
+    def get_similar(self, promt, context_hash):
+        # Most similar cached prompt with the same context, if similar enough
+
+        candidates = [
+            (key.split(":", 1)[1], value)
+            for key, value in self.cache.items()
+            if key.startswith(context_hash + ":")
+        ]
+
+        if len(candidates) == 0:
+            return None
+
+        embeddings = np.stack([self.embed(text) for text, _ in candidates])
+        similarities = embeddings @ self.embed(promt)
+        best = int(np.argmax(similarities))
+
+        if similarities[best] < self.similarity:
+            return None
+
+        return candidates[best][1]
+
+    def put(self, promt, context, response):
+        self.cache.put(self.key(promt, context), dict(response))
+        self.cache.save()
+
+    def clear(self):
+        self.cache.clear()
+        self.cache.save()
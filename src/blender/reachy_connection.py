@@ -0,0 +1,128 @@
+import socket
+import threading
+
+from reachy_sdk import ReachySDK
+
+SDK_PORT = 50055  # Reachy's sdk_port, only open when robot is connected
+
+
+def probe(ip, port=SDK_PORT, timeout=0.5):
+    # If Reachy's SDK server accepts connections
+
+    try:
+        with socket.create_connection((ip, port), timeout):
+            return True
+    except OSError:
+        return False
+
+
+class ReachyConnection:
+    """Keeps a single ReachySDK session, with liveness checked by a
+    heartbeat thread. Callers only read the cached is_alive(), instead of
+    probing the robot themselves. A lost connection is re-established by
+    the heartbeat, retrying with exponential backoff.
+
+    on_connected(reachy) is called with every new session (also after a
+    reconnect), and on_lost() when the connection is lost. Both may be
+    called from the heartbeat thread.
+    """
+
+    def __init__(self, on_connected=None, on_lost=None):
+
+        self.on_connected = on_connected
+        self.on_lost = on_lost
+
+        self.ip = None  # Set while a connection is wanted
+        self.reachy = None
+        self.alive = False
+        self.status = "Disconnected"
+
+        self.heartbeat_interval = 1.0  # Seconds
+        self.backoff_min = 0.5  # Seconds, doubled for every failed reconnect
+        self.backoff_max = 10.0
+
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def is_alive(self):
+        return self.alive
+
+    def is_wanted(self):
+        return self.ip != None
+
+    def open_session(self):
+        # New ReachySDK session, raises if Reachy can't be reached
+
+        if not probe(self.ip):
+            raise ConnectionError("Reachy not available at '%s'" % self.ip)
+
+        reachy = ReachySDK(host=self.ip)
+        reachy.turn_on("reachy")
+
+        if self.on_connected != None:
+            self.on_connected(reachy)
+
+        self.reachy = reachy
+        self.alive = True
+        self.status = "Connected"
+
+    def connect(self, ip):
+        # Blocking first connection, raises if it fails
+
+        self.disconnect()
+
+        self.ip = ip
+        self.status = "Connecting"
+
+        try:
+            self.open_session()
+        except:
+            self.ip = None
+            self.status = "Disconnected"
+            raise
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+
+    def disconnect(self):
+
+        self.stopped.set()
+
+        if self.thread != None and self.thread != threading.current_thread():
+            self.thread.join()
+
+        self.thread = None
+        self.ip = None
+        self.reachy = None
+        self.alive = False
+        self.status = "Disconnected"
+
+    def heartbeat(self):
+
+        backoff = self.backoff_min
+
+        while not self.stopped.wait(self.heartbeat_interval if self.alive else backoff):
+
+            if self.alive:
+                if probe(self.ip):
+                    continue
+
+                print("Reachy connection lost, reconnecting...")
+                self.alive = False
+                self.reachy = None
+                self.status = "Reconnecting"
+                backoff = self.backoff_min
+
+                if self.on_lost != None:
+                    self.on_lost()
+
+                continue
+
+            try:
+                self.open_session()
+                print("Reachy reconnected")
+
+            except Exception:
+                backoff = min(2.0 * backoff, self.backoff_max)
+                self.status = "Reconnecting (retry in %.1f s)" % backoff
@@ -0,0 +1,186 @@
+import numpy as np
+import threading
+import time
+
+from .reachy_cache import LRUCache
+from .reachy_trajectory import Trajectory
+
+# Beat gestures while speaking: joint and degrees of motion at full loudness
+GESTURES = [
+    ("r_arm.r_elbow_pitch", -12.0),
+    ("r_arm.r_wrist_pitch", 8.0),
+    ("l_arm.l_elbow_pitch", -6.0),
+]
+
+
+def speech_envelope(samples, samplerate, rate=25.0, window=0.2):
+    """Loudness of speech sampled at rate (Hz), in the range [0, 1]. RMS of
+    each frame, smoothed over window seconds, and scaled so the loudest
+    parts (95th percentile) are 1. Fades in from and out to 0.
+    """
+    frame_length = max(int(samplerate / rate), 1)
+    frames = len(samples) // frame_length
+
+    if frames == 0:
+        return np.zeros(2, dtype=np.float32)
+
+    # RMS of all frames at once, the incomplete last frame is dropped
+    framed = np.reshape(samples[: frames * frame_length], (frames, frame_length))
+    rms = np.sqrt(np.mean(np.square(framed, dtype=np.float32), axis=1))
+
+    # Centered moving average, precomputed so it can look ahead
+    width = max(int(window * rate), 1)
+    envelope = np.convolve(rms, np.ones(width) / width, mode="same")
+
+    peak = np.percentile(envelope, 95)
+    if peak > 0:
+        envelope = np.minimum(envelope / peak, 1.0)
+
+    # Fade in and out, so gestures never start or stop abruptly
+    envelope = np.concatenate(([0.0], envelope, [0.0]))
+    fade = max(int(0.15 * rate), 1)
+    ramp = np.minimum(np.arange(len(envelope)) / fade, 1.0)
+
+    return (envelope * ramp * ramp[::-1]).astype(np.float32)
+
+
+def gesture_trajectory(envelope, rate, gestures=GESTURES):
+    # Joint offsets (degrees) following the envelope, as a Trajectory
+
+    amplitudes = np.array([amplitude for _, amplitude in gestures], dtype=np.float32)
+
+    return Trajectory(
+        np.arange(len(envelope)) / rate,
+        envelope[:, None] * amplitudes[None, :],
+        [joint for joint, _ in gestures],
+        rate,
+    )
+
+
+class SpeechGestures:
+    """Moves Reachy along with its speech. prepare() turns the audio of a
+    sentence into a trajectory of joint offsets, cached by sentence, so it
+    is ready before the sentence plays. play() starts it, and is called
+    when the sentence starts playing.
+
+    Offsets are added to the pose of the joints when gesturing starts, and
+    are only written while is_busy() is False (no animation, streaming or
+    goto).
+    """
+
+    def __init__(self, gestures=GESTURES, rate=25.0, is_busy=None):
+
+        self.gestures = gestures
+        self.rate = rate  # Samples per second of envelope
+        self.send_rate = 50.0  # Hz
+        self.is_busy = is_busy
+        self.enabled = True
+
+        self.trajectories = LRUCache(64)
+
+        self.joints = []
+        self.columns = []
+        self.lower = None
+        self.upper = None
+
+        self.pending = None  # Trajectory waiting to start
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def prepare(self, key, samples, samplerate):
+
+        if not self.enabled:
+            return None
+
+        trajectory = self.trajectories.get(key)
+
+        if trajectory == None:
+            envelope = speech_envelope(samples, samplerate, self.rate)
+            trajectory = gesture_trajectory(envelope, self.rate, self.gestures)
+            self.trajectories.put(key, trajectory)
+
+        return trajectory
+
+    def play(self, trajectory):
+        # Non blocking, called from the audio thread
+
+        if self.enabled and trajectory != None:
+            self.pending = (trajectory, time.perf_counter())
+
+    def start(self, plan):
+        # Gesture with the joints of the compiled plan, skipping unmapped ones
+
+        self.stop()
+
+        indices = [
+            plan.joint_paths.index(joint)
+            for joint, _ in self.gestures
+            if joint in plan.joint_paths
+        ]
+
+        if len(indices) == 0 or len(plan.joints) == 0:
+            return
+
+        self.joints = [plan.joints[i] for i in indices]
+        self.lower = plan.lower[indices]
+        self.upper = plan.upper[indices]
+
+        # Offsets of the joints that are mapped, in the same order
+        self.columns = [
+            i for i, (joint, _) in enumerate(self.gestures) if joint in plan.joint_paths
+        ]
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.stopped.set()
+
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+        self.pending = None
+
+    def run(self):
+
+        period = 1.0 / self.send_rate
+        trajectory = None
+        base = None
+
+        while not self.stopped.wait(period):
+
+            if self.pending != None:
+                trajectory, start = self.pending
+                self.pending = None
+
+            if trajectory == None:
+                base = None
+                continue
+
+            if self.is_busy != None and self.is_busy():
+                # Animation, streaming or a goto controls the joints, so
+                # gestures start over from wherever they leave them
+                trajectory = None
+                base = None
+                continue
+
+            t = time.perf_counter() - start
+
+            if t > trajectory.duration():
+                trajectory = None
+                continue
+
+            if base is None:
+                base = np.array([joint.present_position for joint in self.joints])
+
+                for joint in self.joints:
+                    joint.compliant = False
+
+            offsets = trajectory.sample(t)[self.columns]
+            positions = np.clip(base + offsets, self.lower, self.upper)
+
+            for joint, position in zip(self.joints, positions.tolist()):
+                joint.goal_position = position
@@ -1,21 +1,143 @@
+import functools
 import json
 import os
+import queue
+import threading
+import time
 from requests.exceptions import RequestException
 
 import bpy
 import openai
 
+from .reachy_cache import ResponseCache
+from .reachy_intent import IntentClassifier
+from .reachy_llm import MockBackend, OpenAIBackend
+from .reachy_memory import ChatMemory
+
+
+class IncrementalJSONFields:
+    """Parses a flat JSON object while it streams in. String values of the top
+    level object are returned by feed() as soon as their closing quote has
+    arrived. Nested values, and text around the object, are ignored.
+    """
+
+    def __init__(self):
+
+        self.fields = {}
+
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.key = None
+        self.buffer = []
+
+    def feed(self, text):
+        # Returns list of (key, value) completed by this text
+
+        completed = []
+
+        for char in text:
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.buffer.append(char)
+                elif char == "\\":
+                    self.escape = True
+                    self.buffer.append(char)
+                elif char == '"':
+                    self.in_string = False
+                    self.end_string(completed)
+                else:
+                    self.buffer.append(char)
+
+            elif char == '"':
+                self.in_string = True
+                self.buffer = []
+
+            elif char in "{[":
+                self.depth += 1
+                self.expect_key = self.depth == 1 and char == "{"
+
+            elif char in "}]":
+                self.depth -= 1
+
+            elif self.depth == 1 and char == ":":
+                self.expect_key = False
+
+            elif self.depth == 1 and char == ",":
+                self.expect_key = True
+                self.key = None
+
+        return completed
+
+    def end_string(self, completed):
+
+        if self.depth != 1:
+            return
+
+        try:
+            value = json.loads('"' + "".join(self.buffer) + '"')
+        except ValueError:
+            value = "".join(self.buffer)
+
+        if self.expect_key:
+            self.key = value
+
+        elif self.key != None:
+            self.fields[self.key] = value
+            completed.append((self.key, value))
+            self.key = None
+
+
+def view3d_context():
+    # Window and area of the first 3D view, to override a timer's context
+
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "VIEW_3D":
+                return {"window": window, "area": area}
+
+    return {}
+
 
 class ReachyGPT:
 
     def __init__(self):
 
-        self.client = None
-        self.chat_history = []
+        self.backend = None  # LLMBackend, set by activate()
+        self.memory = ChatMemory()
+
+        # Asynchronous requests, only one is in flight at a time
+        self.request_id = 0
+        self.request_thread = None
+        self.request_thread_id = 0  # Request of request_thread
+        self.request_results = queue.Queue()
+        self.request_start = 0.0
+        self.timeout = 20.0  # Seconds
+        self.request_messages = []
+
+        # Obvious promts are answered locally, without ChatGPT
+        self.use_intents = True
+        self.intents = IntentClassifier()
+
+        # Responses to previous promts, persisted between Blender sessions
+        self.use_cache = True
+        self.cache = ResponseCache(
+            os.path.join(
+                bpy.utils.user_resource(
+                    "DATAFILES", path="reachy_marionette", create=True
+                ),
+                "gpt_responses.json",
+            )
+        )
+
+        # Sampling of baked actions, as warmed up by the trajectory cache
+        self.animation_rate = None
 
         self.gpt_model = "gpt-4o"
         self.max_tokens = 1000
-        self.chat_history_len = 5
 
         self.action_catalouge = [
             "ReachyWave",
@@ -38,98 +160,164 @@ class ReachyGPT:
             assistant: {"action": "ReachyWave", "answer": "Hej! Hvordan kan jeg hjælpe?"}
             """
 
-    def activate(self, report_blender):
+    def activate(self, report_blender, backend="OpenAI", base_url="", model=""):
+        """Selects the LLM backend: "OpenAI", "Custom" (OpenAI compatible
+        endpoint at base_url, for example an on-prem model) or "Mock" (local
+        deterministic server, no network).
+        """
+        if self.backend != None:
+            self.backend.close()
+            self.backend = None
+
+        if model:
+            self.gpt_model = model
+
+        if backend == "Mock":
+            self.backend = MockBackend()
+            report_blender({"INFO"}, "Mock LLM server at " + self.backend.base_url)
+            return True
+
+        api_key = os.getenv("OPENAI_API_KEY")
+
+        if backend == "Custom":
+            if not base_url:
+                report_blender({"ERROR"}, "Please provide a base URL.")
+                return False
 
-        if not os.getenv("OPENAI_API_KEY"):
+            # Local servers usually don't check the key, but the client needs one
+            self.backend = OpenAIBackend(api_key or "none", base_url)
+            return True
+
+        if not api_key:
             report_blender(
                 {"ERROR"},
                 "No API key detected. Please write API key to OPENAI_API_KEY environment variable. System restart may be required after writing to environment variable.",
             )
             return False
 
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.backend = OpenAIBackend(api_key)
 
         return True
 
     def get_gpt_response(self, messages, report_blender):
 
         try:
-            # Request response from ChatGPT
-            response = self.client.chat.completions.create(
-                model=self.gpt_model,
-                messages=messages,
-                max_tokens=self.max_tokens,
+            # Request response from the LLM backend
+            content = self.backend.complete(
+                messages, self.gpt_model, self.max_tokens, self.timeout
             )
 
-            if hasattr(response, "choices") and len(response.choices) > 0:
-                message = json.loads(response.choices[0].message.content)
-
-                if "action" not in message and "answer" not in message:
-                    report_blender(
-                        {"ERROR"}, "Message not formatted correctly: " + str(message)
-                    )
-                    return "Sorry, I couldn't generate a response."
+            if content:
+                message = json.loads(content)
 
-                return message
+                return self.parse_message(message, report_blender)
 
             else:
                 report_blender({"ERROR"}, "No completion choices returned.")
                 return "Sorry, I couldn't generate a response."
 
-        except openai.OpenAIError as error:
+        except Exception as error:
+            return self.report_error(error, report_blender)
+
+    def report_error(self, error, report_blender):
+        # Reports error of a request, returns the answer to give instead
+
+        if isinstance(error, openai.OpenAIError):
             report_blender({"ERROR"}, "OpenAI API error: " + str(error))
             return "Sorry, there was an error with the AI service."
 
-        except RequestException as e:
+        if isinstance(error, RequestException):
             report_blender({"ERROR"}, "Request error: " + str(error))
             return "Sorry, there was a network issue."
 
-        except Exception as error:
-            report_blender({"ERROR"}, "Could not send response: " + str(error))
-            return "Sorry, something went wrong."
+        report_blender({"ERROR"}, "Could not send response: " + str(error))
+        return "Sorry, something went wrong."
+
+    def parse_message(self, message, report_blender):
+        # Check content of response, returns error text if malformed
 
-    def send_request(self, promt, reachy_object, report_blender):
+        if "action" not in message and "answer" not in message:
+            report_blender(
+                {"ERROR"}, "Message not formatted correctly: " + str(message)
+            )
+            return "Sorry, I couldn't generate a response."
 
-        response = {"action": "", "answer": ""}  # Mock response
+        return message
+
+    def get_gpt_response_stream(
+        self, messages, report_blender, on_field, is_cancelled=None
+    ):
+        """Like get_gpt_response(), but streams the completion. on_field(key,
+        value) is called for each top level string value as soon as it is
+        complete, so "action" is known before "answer" has been generated.
+        """
+        try:
+            stream = self.backend.stream(
+                messages, self.gpt_model, self.max_tokens, self.timeout
+            )
+
+            parser = IncrementalJSONFields()
+
+            for text in stream:
+                if is_cancelled != None and is_cancelled():
+                    stream.close()
+                    return "Sorry, the request was cancelled."
+
+                for key, value in parser.feed(text):
+                    on_field(key, value)
+
+            if len(parser.fields) == 0:
+                report_blender({"ERROR"}, "No completion returned.")
+                return "Sorry, I couldn't generate a response."
+
+            return self.parse_message(parser.fields, report_blender)
+
+        except Exception as error:
+            return self.report_error(error, report_blender)
+
+    def build_messages(self, promt, report_blender):
+        # Messages to send for the promt, None if the request can't be sent
 
         if len(promt) == 0:
             report_blender({"ERROR"}, "Please provide a promt.")
-            return response
+            return None
 
-        if not self.client:
+        if not self.backend:
             report_blender(
-                {"ERROR"}, "No OpenAI client detected. Please activate client."
+                {"ERROR"}, "No LLM backend detected. Please activate client."
             )
-            return response
+            return None
 
-        # Add system promt and recent chat history
+        # Add system promt, and summary and recent messages of the conversation
         messages = [{"role": "system", "content": self.system_prompt}]
-        messages.extend(self.chat_history[-self.chat_history_len :])
+        messages.extend(self.memory.context())
 
         # Add user promt
-        message_user = {"role": "user", "content": promt}
-        messages.append(message_user)
-        self.chat_history.append(message_user)
+        messages.append({"role": "user", "content": promt})
+        self.memory.add("user", promt)
 
-        # Get response from ChatGPT, and send action / animation to Reachy
-        response = self.get_gpt_response(messages, report_blender)
+        return messages
 
-        if response["action"] not in self.action_catalouge:
-            report_blender(
-                {"ERROR"}, "Response was not an action: " + response["action"]
-            )
-            response["action"] = "ReachyShrug"
+    def dispatch_action(self, action, reachy_object, report_blender):
+        # Play action on Reachy, or in Blender if not connected. Errors are
+        # reported, so the answer is still given
 
-        report_blender({"INFO"}, "Chosen action: " + response["action"])
-        report_blender({"INFO"}, response["answer"])
+        try:
+            # Responses are handled by timers, which have no window. Screen
+            # operators and context.object need one, so use a 3D view's
+            with bpy.context.temp_override(**view3d_context()):
+                self.play_action(action, reachy_object, report_blender)
 
-        bpy.context.object.animation_data.action = bpy.data.actions.get(
-            response["action"]
-        )
+        except Exception as error:
+            report_blender({"ERROR"}, "Could not play action: " + str(error))
+
+    def play_action(self, action, reachy_object, report_blender):
+
+        bpy.context.object.animation_data.action = bpy.data.actions.get(action)
 
         if reachy_object.reachy != None:
             # Send action to Reachy robot
-            reachy_object.animate_angles(report_blender)
+            reachy_object.animate_angles(report_blender, self.animation_rate)
 
         else:
             report_blender({"INFO"}, "Reachy not connected, playing animation instead.")
@@ -139,4 +327,235 @@ class ReachyGPT:
             bpy.ops.screen.frame_jump()
             bpy.ops.screen.animation_play()
 
+    def handle_response(
+        self, response, reachy_object, report_blender, dispatched_action=None
+    ):
+        # Send action / animation of response to Reachy, must run on main thread
+
+        if isinstance(response, dict):
+            # Kept in memory, so ChatGPT knows what it answered
+            self.memory.add(
+                "assistant",
+                {"action": response.get("action"), "answer": response.get("answer")},
+            )
+
+        else:
+            # Error message from get_gpt_response
+            response = {"action": "", "answer": response}
+
+        if response.get("action") not in self.action_catalouge:
+            report_blender(
+                {"ERROR"}, "Response was not an action: " + str(response.get("action"))
+            )
+            response["action"] = "ReachyShrug"
+
+        response.setdefault("answer", "")
+
+        report_blender({"INFO"}, "Chosen action: " + response["action"])
+        report_blender({"INFO"}, response["answer"])
+
+        # Streamed responses may already have started the action
+        if response["action"] != dispatched_action:
+            self.dispatch_action(response["action"], reachy_object, report_blender)
+
+        return response
+
+    def get_local_response(self, promt, report_blender):
+        # Response of the local intent classifier, None if it isn't confident
+
+        if not self.use_intents or len(promt) == 0:
+            return None
+
+        response, confidence = self.intents.classify(promt)
+
+        if response == None:
+            return None
+
+        report_blender({"INFO"}, "Local intent (confidence %.2f)" % confidence)
+
+        # Kept in memory, so ChatGPT knows what was said
+        self.memory.add("user", promt)
+
         return response
+
+    def get_cached_response(self, messages):
+        # Cached response to the promt (last message) in the same context
+
+        if not self.use_cache:
+            return None
+
+        return self.cache.get(messages[-1]["content"], messages[1:-1])
+
+    def cache_response(self, messages, response):
+
+        if not self.use_cache or not isinstance(response, dict):
+            return
+
+        # Errors and malformed responses are not worth repeating
+        if response.get("action") in self.action_catalouge and response.get("answer"):
+            self.cache.put(messages[-1]["content"], messages[1:-1], response)
+
+    def is_request_pending(self):
+        # Also while a cancelled request has not returned yet
+        return self.request_thread != None and self.request_thread.is_alive()
+
+    def is_request_cancelled(self):
+        return self.is_request_pending() and self.request_thread_id != self.request_id
+
+    def send_request_async(
+        self,
+        promt,
+        reachy_object,
+        report_blender,
+        on_response=None,
+        timeout=None,
+        stream=False,
+    ):
+        """Sends request on a worker thread and returns right away. The
+        response is handled on the main thread by a Blender timer, which then
+        calls on_response(response). Returns False if request was not sent.
+        With stream, the action is started as soon as it has been received,
+        while the answer is still being generated.
+        """
+        if self.is_request_pending():
+            report_blender({"INFO"}, "Waiting for response to previous request...")
+            return False
+
+        # Local intent, then cached response, before asking ChatGPT
+        response = self.get_local_response(promt, report_blender)
+
+        if response == None:
+            messages = self.build_messages(promt, report_blender)
+
+            if messages == None:
+                return False
+
+            response = self.get_cached_response(messages)
+
+            if response != None:
+                report_blender({"INFO"}, "Using cached response")
+
+        if response != None:
+            response = self.handle_response(response, reachy_object, report_blender)
+
+            if on_response != None:
+                on_response(response)
+
+            return True
+
+        if timeout != None:
+            self.timeout = timeout
+
+        self.request_messages = messages
+
+        self.request_id += 1
+        self.request_thread_id = self.request_id
+        self.request_start = time.perf_counter()
+
+        self.request_thread = threading.Thread(
+            target=self.request_worker,
+            args=[self.request_id, messages, stream],
+            daemon=True,
+        )
+        self.request_thread.start()
+
+        bpy.app.timers.register(
+            functools.partial(
+                self.poll_request,
+                self.request_id,
+                reachy_object,
+                report_blender,
+                on_response,
+                None,
+            ),
+            first_interval=0.05,
+        )
+
+        return True
+
+    def cancel_request(self):
+        # Response of a cancelled request is ignored when it arrives. Its
+        # worker is still pending until the request returns (at the next
+        # chunk if streamed, else within the timeout), so only one request
+        # is ever in flight
+        self.request_id += 1
+
+    def request_worker(self, request_id, messages, stream=False):
+
+        # Blender can't be reported to outside the main thread, collect messages
+        reports = []
+
+        def report_later(report_type, message):
+            reports.append((report_type, message))
+
+        if stream:
+
+            def on_field(key, value):
+                if key == "action":
+                    self.request_results.put((request_id, "action", value, []))
+
+            def is_cancelled():
+                return request_id != self.request_id
+
+            response = self.get_gpt_response_stream(
+                messages, report_later, on_field, is_cancelled
+            )
+
+        else:
+            response = self.get_gpt_response(messages, report_later)
+
+        self.request_results.put((request_id, "response", response, reports))
+
+    def poll_request(
+        self, request_id, reachy_object, report_blender, on_response, action
+    ):
+        # Blender timer, delivers results of worker thread on the main thread.
+        # action is the action already started from a streamed response
+
+        if request_id != self.request_id:
+            return None  # Cancelled
+
+        next_poll = functools.partial(
+            self.poll_request,
+            request_id,
+            reachy_object,
+            report_blender,
+            on_response,
+        )
+
+        try:
+            result_id, kind, result, reports = self.request_results.get_nowait()
+
+        except queue.Empty:
+            if time.perf_counter() - self.request_start > self.timeout + 1.0:
+                report_blender({"ERROR"}, "ChatGPT request timed out.")
+                self.cancel_request()
+                return None
+
+            return 0.05  # Seconds till next poll
+
+        if result_id != request_id:
+            return 0.0  # Late result of a cancelled request
+
+        for report_type, message in reports:
+            report_blender(report_type, message)
+
+        if kind == "action":
+            # Start motion early, answer is still streaming
+            if result in self.action_catalouge:
+                self.dispatch_action(result, reachy_object, report_blender)
+                action = result
+
+            bpy.app.timers.register(
+                functools.partial(next_poll, action), first_interval=0.05
+            )
+            return None
+
+        self.cache_response(self.request_messages, result)
+
+        response = self.handle_response(result, reachy_object, report_blender, action)
+
+        if on_response != None:
+            on_response(response)
+
+        return None
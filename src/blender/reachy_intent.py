@@ -0,0 +1,136 @@
+from .reachy_cache import normalize_text
+
+# Obvious promts and how to respond to them, without asking ChatGPT.
+# Phrases are matched as whole (normalized) words, Danish and English.
+INTENTS = [
+    {
+        "action": "ReachyWave",
+        "answer": "Hej! Hvordan kan jeg hjælpe?",
+        "phrases": [
+            "hej",
+            "hejsa",
+            "halløj",
+            "goddag",
+            "godmorgen",
+            "god morgen",
+            "hello",
+            "hi",
+            "hey",
+            "good morning",
+            "vink",
+            "wave",
+        ],
+    },
+    {
+        "action": "ReachyWave",
+        "answer": "Farvel, hav en god dag!",
+        "phrases": ["farvel", "vi ses", "bye", "goodbye", "see you"],
+    },
+    {
+        "action": "ReachyDance",
+        "answer": "Selvfølgelig, se lige her!",
+        "phrases": ["dans", "danse", "dance", "dancing"],
+    },
+    {
+        "action": "ReachyYes",
+        "answer": "Ja!",
+        "phrases": ["ja", "jo", "jep", "yes", "yeah", "ok", "okay", "nik", "nod"],
+    },
+    {
+        "action": "ReachyYes",
+        "answer": "Selv tak!",
+        "phrases": ["tak", "mange tak", "tusind tak", "thanks", "thank you"],
+    },
+    {
+        "action": "ReachyNo",
+        "answer": "Nej.",
+        "phrases": ["nej", "nope", "no", "ryst på hovedet", "shake your head"],
+    },
+]
+
+# Words that don't change the meaning of a short promt
+FILLER_WORDS = set(
+    "reachy robot du kan vil mig til for lige så og en et venligst "
+    "please you can will me to a the and so oh åh just".split()
+)
+
+
+class IntentClassifier:
+    """Maps obvious promts directly to an action and a canned answer.
+
+    Confidence is the share of the promt's words explained by the phrases of
+    a single intent, ignoring filler words. Promts matching several actions
+    have no confidence. An optional offline model, a callable returning
+    (action, confidence) for a promt, is asked when no phrase matches well.
+    """
+
+    def __init__(self, intents=INTENTS, confidence=0.75):
+
+        self.intents = intents
+        self.confidence = confidence  # Threshold for answering locally
+        self.model = None
+
+        # Phrases as word tuples, longest first so they are matched greedily
+        self.phrases = sorted(
+            (
+                (tuple(normalize_text(phrase).split()), index)
+                for index, intent in enumerate(intents)
+                for phrase in intent["phrases"]
+            ),
+            key=lambda phrase: -len(phrase[0]),
+        )
+
+        # Default answer for actions chosen by the model
+        self.answers = {}
+        for intent in intents:
+            self.answers.setdefault(intent["action"], intent["answer"])
+
+    def match(self, words):
+        # Intent indices matched by phrases, and number of words explained
+
+        matched = set()
+        explained = 0
+        i = 0
+
+        while i < len(words):
+            for phrase, index in self.phrases:
+                if tuple(words[i : i + len(phrase)]) == phrase:
+                    matched.add(index)
+                    explained += len(phrase)
+                    i += len(phrase)
+                    break
+            else:
+                explained += words[i] in FILLER_WORDS
+                i += 1
+
+        return matched, explained
+
+    def classify(self, promt):
+        # Returns (response, confidence), response is None when not confident
+
+        words = normalize_text(promt).split()
+
+        if len(words) == 0:
+            return None, 0.0
+
+        matched, explained = self.match(words)
+        actions = {self.intents[index]["action"] for index in matched}
+
+        if len(actions) == 1:
+            confidence = explained / len(words)
+
+            if confidence >= self.confidence:
+                # Prefer the first intent listed, when several give the action
+                intent = self.intents[min(matched)]
+                return {
+                    "action": intent["action"],
+                    "answer": intent["answer"],
+                }, confidence
+
+        if self.model != None:
+            action, confidence = self.model(promt)
+
+            if action in self.answers and confidence >= self.confidence:
+                return {"action": action, "answer": self.answers[action]}, confidence
+
+        return None, 0.0
@@ -0,0 +1,85 @@
+from abc import ABC, abstractmethod
+
+import openai
+
+from .reachy_mock_llm import MockLLMServer
+
+
+class LLMBackend(ABC):
+    """Chat completions backend used by ReachyGPT.
+
+    complete() returns the content of the completion, stream() yields it in
+    chunks as they arrive. Closing the generator returned by stream() closes
+    the connection. Errors of the underlying client are raised as is.
+    """
+
+    name = "LLM"
+
+    @abstractmethod
+    def complete(self, messages, model, max_tokens, timeout): ...
+
+    @abstractmethod
+    def stream(self, messages, model, max_tokens, timeout): ...
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    # OpenAI, or any OpenAI compatible endpoint (vLLM, Ollama, LM Studio...)
+
+    name = "OpenAI"
+
+    def __init__(self, api_key, base_url=None):
+        self.base_url = base_url
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+
+    def complete(self, messages, model, max_tokens, timeout):
+
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            timeout=timeout,
+        )
+
+        if not hasattr(response, "choices") or len(response.choices) == 0:
+            return None
+
+        return response.choices[0].message.content
+
+    def stream(self, messages, model, max_tokens, timeout):
+
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            stream=True,
+        )
+
+        try:
+            for chunk in stream:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        finally:
+            stream.close()
+
+
+class MockBackend(OpenAIBackend):
+    """Local deterministic mock server, reached over HTTP like a real
+    endpoint, for testing and benchmarking without network or API key.
+    """
+
+    name = "Mock"
+
+    def __init__(self, latency=0.3, chunk_delay=0.02):
+
+        self.server = MockLLMServer(latency=latency, chunk_delay=chunk_delay)
+        self.server.start()
+
+        super().__init__("mock", self.server.base_url())
+
+    def close(self):
+        self.server.stop()
@@ -1,16 +1,17 @@
 from enum import Enum
 import functools
-import mathutils
-import numpy as np
-import socket
-import threading
+import time
 
 import bpy
-from reachy_sdk import ReachySDK
-from reachy_sdk.reachy_sdk import flush_communication
 from reachy_sdk.trajectory import goto
 from reachy_sdk.trajectory.interpolation import InterpolationMode
 
+from .reachy_connection import ReachyConnection
+from .reachy_gesture import SpeechGestures
+from .reachy_rig import JointPlan, RigAngleExtractor, load_joint_mapping
+from .reachy_stream import StreamSender, TrajectoryPlayer
+from .reachy_trajectory import TrajectoryCache
+
 
 class State(Enum):
     IDLE = 0
@@ -22,100 +23,114 @@ class ReachyMarionette:
 
     def __init__(self):
 
-        self.reachy = None
+        self.connection = ReachyConnection(self.on_connected, self.on_lost)
         self.state = State.IDLE
-        self.threads = []
+        self.extractor = None
+        self.plan = JointPlan(load_joint_mapping())
+
+        self.sender = StreamSender()
+        self.stream_rate = 30.0  # Hz
+        self.deadband = 0.5  # Degrees
+
+        self.player = TrajectoryPlayer()
+        self.trajectories = TrajectoryCache(
+            bpy.utils.user_resource(
+                "DATAFILES", path="reachy_marionette/trajectories", create=True
+            )
+        )
+
+        # Beat gestures along with speech, while nothing else moves Reachy
+        self.moving = False  # While a goto is in progress
+        self.gestures = SpeechGestures(
+            is_busy=lambda: self.state != State.IDLE or self.moving
+        )
 
-        self.stream_interval = 2.0
+        # Event driven streaming
+        self.stream_handlers = []
+        self.stream_time_prev = 0.0
+        self.stream_pending = False
 
     def __del__(self):
         self.set_state_idle()
 
-        for thread in self.threads:
-            thread.join()
+    def is_streaming(self):
+        return self.state == State.STREAMING
 
     def set_state_idle(self):
         self.state = State.IDLE
+        self.sender.stop()
+        self.player.cancel()
+        self.remove_stream_handlers()
 
-    # Helper functions from rigify plugin
-
-    def get_pose_matrix_in_other_space(self, mat, pose_bone):
-        """Returns the transform matrix relative to pose_bone's current
-        transform space. In other words, presuming that mat is in
-        armature space, slapping the returned matrix onto pose_bone
-        should give it the armature-space transforms of mat.
-        TODO: try to handle cases with axis-scaled parents better.
-        """
-        rest = pose_bone.bone.matrix_local.copy()
-        rest_inv = rest.inverted()
-
-        if pose_bone.parent.name != "Root":
-            par_mat = pose_bone.parent.matrix.copy()
-            par_inv = par_mat.inverted()
-            par_rest = pose_bone.parent.bone.matrix_local.copy()
-        else:
-            par_mat = mathutils.Matrix()
-            par_inv = mathutils.Matrix()
-            par_rest = mathutils.Matrix()
+    def load_mapping(self, report_blender, file_path=""):
+        # Load bone to joint mapping table, empty path uses the default table
 
-        # Get matrix in bone's current transform space
-        smat = rest_inv @ (par_rest @ (par_inv @ mat))
+        try:
+            if len(file_path) == 0:
+                self.plan = JointPlan(load_joint_mapping())
+            else:
+                self.plan = JointPlan(load_joint_mapping(file_path))
 
-        return smat
+        except (OSError, ValueError) as error:
+            report_blender({"ERROR"}, "Could not load joint mapping: " + str(error))
+            return False
 
-    def get_bones_rotation(self, pose_bone, axis):
+        # Extractor depends on the bones of the plan
+        self.extractor = None
 
-        mat = self.get_pose_matrix_in_other_space(pose_bone.matrix, pose_bone)
+        return True
 
-        if axis == 0:
-            return mat.to_euler().x
-        elif axis == 1:
-            return mat.to_euler().y
-        elif axis == 2:
-            return mat.to_euler().z
+    def get_angles(self, armature):
+        # Joint angles of all mapped bones, in the order of the joint plan
 
-    def angle_of_bone(self, name):
+        if self.extractor == None or not self.extractor.is_valid_for(armature):
+            self.extractor = RigAngleExtractor(
+                armature, self.plan.bone_names, self.plan.axes
+            )
 
-        bone = bpy.context.object.pose.bones[name]
-        # Get unconstrained axis
-        axis_rot = (np.array(bone.lock_rotation) == False).nonzero()[0][0]
+        return self.plan.joint_angles(self.extractor.angles(armature))
 
-        return np.rad2deg(self.get_bones_rotation(bone, axis_rot))
+    @property
+    def reachy(self):
+        # Current ReachySDK session, None if not connected (or reconnecting)
+        return self.connection.reachy
 
-    def ensure_connection(self, report_blender, ip="localhost", timeout=0.1):
+    def on_connected(self, reachy):
+        # New session, joints of the previous one are no longer valid
 
-        port = 50055  # Reachy's sdk_port, only open when robot is connected
+        self.plan.compile(reachy)
+        self.gestures.start(self.plan)
 
-        try:
-            with socket.create_connection((ip, port), timeout):
-                return True
-        except OSError:
-            report_blender(
-                {"WARNING"},
-                "Reachy connection not available",
-            )
+        if self.state == State.STREAMING:
+            for joint in self.plan.joints:
+                joint.compliant = False
 
-            if self.reachy != None:
-                report_blender(
-                    {"WARNING"},
-                    "Deleting existing reachy instance, Reachy was not shut down properly",
-                )
-                self.reachy = None
+    def on_lost(self):
+        self.gestures.stop()
 
-            return False
+    def ensure_connection(self, report_blender):
+        # Liveness is tracked by the connection's heartbeat, no probe needed
 
-    def connect_reachy(self, report_blender, ip="localhost"):
+        if self.connection.is_alive():
+            return True
 
-        self.ensure_connection(report_blender)
+        if self.connection.is_wanted():
+            report_blender({"WARNING"}, "Reachy connection lost, reconnecting...")
+
+        return False
+
+    def connect_reachy(self, report_blender, ip="localhost", mapping_path=""):
 
-        if self.reachy != None:
+        if self.connection.is_alive() and self.connection.ip == ip:
             report_blender({"INFO"}, "Connection already established at '%s'" % ip)
             return
 
+        # Keeps previous mapping if the new one can't be loaded
+        self.load_mapping(report_blender, mapping_path)
+
         # Try connection
         try:
-            self.reachy = ReachySDK(host=ip)
-            self.reachy.turn_on("reachy")
+            self.connection.connect(ip)
             report_blender({"INFO"}, "Connection established succesfully!")
 
         except:
@@ -123,152 +138,306 @@ class ReachyMarionette:
 
     def disconnect_reachy(self, report_blender):
 
-        self.ensure_connection(report_blender)
+        # Also stops reconnecting, if the connection was lost
+        if self.connection.is_wanted():
+            self.set_state_idle()
+            self.gestures.stop()
+
+            if self.connection.is_alive():
+                self.reachy_reset_pose()
 
-        # Try connection
-        if self.reachy != None:
-            self.reachy_reset_pose()
             # self.reachy.turn_off_smoothly('reachy')
             # flush_communication()
             report_blender({"WARNING"}, "Proper disconnection disabled!")
-            self.reachy = None
+            self.connection.disconnect()
             report_blender({"INFO"}, "Disconnected Reachy")
 
         else:
             report_blender({"INFO"}, "No Reachy is connected")
 
     def reachy_goto(self, joint_angles, duration=1.0):
+        # Blocks until the goal is reached, gestures pause meanwhile
 
-        goto(
-            goal_positions=joint_angles,
-            duration=duration,
-            interpolation_mode=InterpolationMode.MINIMUM_JERK,
-        )
+        self.moving = True
 
-    def send_angles(self, report_blender, duration=1.0, threaded=False):
+        try:
+            goto(
+                goal_positions=joint_angles,
+                duration=duration,
+                interpolation_mode=InterpolationMode.MINIMUM_JERK,
+            )
+        finally:
+            self.moving = False
 
-        self.ensure_connection(report_blender)
+    def current_angles(self, report_blender):
+        # Joint angles of the selected rig, None if they can't be sent
 
         if self.reachy == None:
             report_blender({"ERROR"}, "Reachy not connected!")
-            return
+            return None
 
-        if bpy.context.object.type != "ARMATURE":
+        if bpy.context.object == None or bpy.context.object.type != "ARMATURE":
             report_blender({"ERROR"}, "Please select Armature")
-            return
+            return None
 
-        joint_angle_positions = {
-            # Right arm
-            self.reachy.r_arm.r_shoulder_pitch: self.angle_of_bone("shoulder_pitch.R")
-            * (-1),
-            self.reachy.r_arm.r_shoulder_roll: self.angle_of_bone("shoulder_roll.R"),
-            self.reachy.r_arm.r_arm_yaw: self.angle_of_bone("shoulder_yaw.R") * (-1),
-            self.reachy.r_arm.r_elbow_pitch: self.angle_of_bone("elbow_pitch.R"),
-            self.reachy.r_arm.r_forearm_yaw: self.angle_of_bone("forearm_yaw.R") * (-1),
-            self.reachy.r_arm.r_wrist_pitch: self.angle_of_bone("wrist_pitch.R"),
-            self.reachy.r_arm.r_wrist_roll: self.angle_of_bone("wrist_roll.R"),
-            self.reachy.r_arm.r_gripper: self.angle_of_bone("gripper.R"),
-            # Left arm
-            self.reachy.l_arm.l_shoulder_pitch: self.angle_of_bone("shoulder_pitch.L"),
-            self.reachy.l_arm.l_shoulder_roll: self.angle_of_bone("shoulder_roll.L"),
-            self.reachy.l_arm.l_arm_yaw: self.angle_of_bone("shoulder_yaw.L") * (-1),
-            self.reachy.l_arm.l_elbow_pitch: self.angle_of_bone("elbow_pitch.L"),
-            self.reachy.l_arm.l_forearm_yaw: self.angle_of_bone("forearm_yaw.L"),
-            self.reachy.l_arm.l_wrist_pitch: self.angle_of_bone("wrist_pitch.L"),
-            self.reachy.l_arm.l_wrist_roll: self.angle_of_bone("wrist_roll.L"),
-            self.reachy.l_arm.l_gripper: self.angle_of_bone("gripper.L"),
-        }
-
-        if threaded:
-            thread = threading.Thread(
-                target=self.reachy_goto, args=[joint_angle_positions, duration]
-            )
-            self.threads.append(thread)
-            thread.start()
+        return self.get_angles(bpy.context.object)
 
-        else:
-            self.reachy_goto(joint_angle_positions, duration)
+    def send_angles(self, report_blender, duration=1.0):
+
+        self.ensure_connection(report_blender)
+
+        angles = self.current_angles(report_blender)
+
+        if angles is None:
+            return
+
+        self.reachy_goto(dict(zip(self.plan.joints, angles.tolist())), duration)
 
     def stream_angles(self, report_blender):
 
-        self.ensure_connection(report_blender)
+        if self.state != State.STREAMING:
+            return None
 
-        if self.state == State.STREAMING:
-            # Duration is faster than the interval, to finish before the next thread
-            self.send_angles(
-                report_blender, duration=self.stream_interval * 0.5, threaded=True
-            )
-            return self.stream_interval  # Seconds till next function call
-        else:
+        if self.connection.is_wanted() and not self.connection.is_alive():
+            # Paused until the heartbeat has reconnected
+            return 1.0 / self.stream_rate
+
+        armature = bpy.context.object
+
+        if armature == None or armature.type != "ARMATURE":
+            # Paused while another object is selected, resumes with the rig
+            return 1.0 / self.stream_rate
+
+        angles = self.current_angles(report_blender)
+
+        if angles is None:
+            self.set_state_idle()
+            return None
+
+        # Sender thread writes the newest angles at its own rate
+        self.sender.post(self.plan.joints, angles)
+
+        return 1.0 / self.stream_rate  # Seconds till next function call
+
+    def stream_angles_event(self, report_blender):
+        # Send current pose, rate limited to stream_rate
+
+        if self.state != State.STREAMING:
             return None
 
-    def stream_angles_enable(self, report_blender):
+        wait = self.stream_time_prev + 1.0 / self.stream_rate - time.perf_counter()
+
+        if wait > 0:
+            # Too soon, send the latest pose when the rate allows it
+            if not self.stream_pending:
+                self.stream_pending = True
+                bpy.app.timers.register(
+                    functools.partial(self.stream_angles_deferred, report_blender),
+                    first_interval=wait,
+                )
+            return None
+
+        self.stream_time_prev = time.perf_counter()
+        self.stream_angles(report_blender)
+
+        return None
+
+    def stream_angles_deferred(self, report_blender):
+        self.stream_pending = False
+
+        return self.stream_angles_event(report_blender)
+
+    def on_depsgraph_update(self, report_blender, scene, depsgraph):
+
+        armature = bpy.context.object
+
+        if armature == None or armature.type != "ARMATURE":
+            return
+
+        # Only react when the active armature was changed
+        for update in depsgraph.updates:
+            if update.id.original == armature:
+                self.stream_angles_event(report_blender)
+                return
+
+    def on_frame_change(self, report_blender, scene, depsgraph=None):
+        self.stream_angles_event(report_blender)
+
+    def add_stream_handlers(self, report_blender):
+
+        self.remove_stream_handlers()
+
+        self.stream_handlers = [
+            (
+                bpy.app.handlers.depsgraph_update_post,
+                functools.partial(self.on_depsgraph_update, report_blender),
+            ),
+            (
+                bpy.app.handlers.frame_change_post,
+                functools.partial(self.on_frame_change, report_blender),
+            ),
+        ]
+
+        for handlers, handler in self.stream_handlers:
+            handlers.append(handler)
+
+    def remove_stream_handlers(self):
+
+        for handlers, handler in self.stream_handlers:
+            if handler in handlers:
+                handlers.remove(handler)
+
+        self.stream_handlers = []
+
+    def stream_angles_enable(
+        self, report_blender, rate=None, deadband=None, event_driven=False
+    ):
 
         self.ensure_connection(report_blender)
 
+        if self.reachy == None:
+            report_blender({"ERROR"}, "Reachy not connected!")
+            return
+
         if not self.state == State.STREAMING:
             self.state = State.STREAMING
 
-            # Create Blender timer
-            bpy.app.timers.register(
-                functools.partial(self.stream_angles, report_blender)
+            if rate != None:
+                self.stream_rate = rate
+
+            if deadband != None:
+                self.deadband = deadband
+
+            self.sender.start(
+                self.plan.joints,
+                self.stream_rate,
+                self.plan.joint_deadbands(self.deadband),
             )
 
+            if event_driven:
+                # Send on pose changes only, starting with the current pose
+                self.stream_time_prev = 0.0
+                self.stream_pending = False
+                self.add_stream_handlers(report_blender)
+                self.stream_angles_event(report_blender)
+
+            else:
+                # Create Blender timer
+                bpy.app.timers.register(
+                    functools.partial(self.stream_angles, report_blender)
+                )
+
         else:
             report_blender({"INFO"}, "Streaming is already in progress,")
 
-    def animate_angles(self, report_blender):
+    def bake_animation(self, report_blender, rate=None):
+        # Bake active action of the selected rig into a joint trajectory
 
-        self.ensure_connection(report_blender)
+        armature = bpy.context.object
 
-        if not self.state == State.ANIMATING:
-            self.state = State.ANIMATING
+        if armature == None or armature.type != "ARMATURE":
+            report_blender({"ERROR"}, "Please select Armature")
+            return None
 
-            frame_prev = 0
-            bpy.data.scenes["Scene"].show_keys_from_selected_only = False
-            bpy.data.scenes["Scene"].frame_set(frame_prev)
+        if armature.animation_data == None or armature.animation_data.action == None:
+            report_blender({"ERROR"}, "Armature has no action to animate")
+            return None
 
-            # Get to initial pose
-            self.send_angles(report_blender, duration=1.0, threaded=False)
+        trajectory = self.trajectories.get_or_bake(
+            bpy.context.scene,
+            armature,
+            armature.animation_data.action,
+            self.plan,
+            self.get_angles,
+            rate,
+        )
+
+        if len(trajectory) == 0:
+            report_blender({"ERROR"}, "Action has no keyframes")
+            return None
 
-            # Iterate through all keyframes
-            while (
-                bpy.ops.screen.keyframe_jump(next=True) == {"FINISHED"}
-                and self.state == State.ANIMATING
-            ):
+        return trajectory
 
-                frame_diff = bpy.data.scenes["Scene"].frame_current - frame_prev
-                duration = frame_diff / bpy.context.scene.render.fps
-                frame_prev = bpy.data.scenes["Scene"].frame_current
+    def find_armature(self):
+        # Armature with all bones of the joint plan, preferring the selected
+        # one. Actions can only be assigned to armatures with animation data
 
-                # Wait for movement to complete before moving on to next keyframe
-                self.send_angles(report_blender, duration, threaded=False)
+        candidates = [getattr(bpy.context, "object", None)] + list(bpy.data.objects)
 
+        for candidate in candidates:
+            if candidate == None or candidate.type != "ARMATURE":
+                continue
+
+            if candidate.animation_data == None:
+                continue
+
+            if all(name in candidate.pose.bones for name in self.plan.bone_names):
+                return candidate
+
+        return None
+
+    def warm_trajectory_cache(self, action_names, rate=None):
+        # Bake actions ahead of time, so they can start playing right away
+
+        armature = self.find_armature()
+
+        if armature == None:
+            return
+
+        for action_name in action_names:
+            action = bpy.data.actions.get(action_name)
+
+            if action == None:
+                continue
+
+            try:
+                self.trajectories.get_or_bake(
+                    bpy.context.scene,
+                    armature,
+                    action,
+                    self.plan,
+                    self.get_angles,
+                    rate,
+                )
+            except Exception as error:
+                print("Could not bake action '%s': %s" % (action_name, error))
+
+    def set_animation_finished(self):
+        # Called from the player thread when playback ends
+        if self.state == State.ANIMATING:
             self.state = State.IDLE
 
-        else:
+    def animate_angles(self, report_blender, rate=None):
+        # Start playing the active action, returns without waiting for it
+
+        self.ensure_connection(report_blender)
+
+        if self.reachy == None:
+            report_blender({"ERROR"}, "Reachy not connected!")
+            return False
+
+        if self.player.is_playing():
             report_blender({"INFO"}, "Animation is already in progress,")
+            return False
+
+        trajectory = self.bake_animation(report_blender, rate)
+
+        if trajectory == None:
+            return False
+
+        self.set_state_idle()
+        self.state = State.ANIMATING
+        self.player.play(trajectory, self.plan.joints, self.set_animation_finished)
+
+        return True
+
+    def pause_animation(self):
+        self.player.pause()
+
+    def resume_animation(self):
+        self.player.resume()
 
     def reachy_reset_pose(self):
-        joint_angles = {
-            # Right arm
-            self.reachy.r_arm.r_shoulder_pitch: 0,
-            self.reachy.r_arm.r_shoulder_roll: 0,
-            self.reachy.r_arm.r_arm_yaw: 0,
-            self.reachy.r_arm.r_elbow_pitch: 0,
-            self.reachy.r_arm.r_forearm_yaw: 0,
-            self.reachy.r_arm.r_wrist_pitch: 0,
-            self.reachy.r_arm.r_wrist_roll: 0,
-            self.reachy.r_arm.r_gripper: 0,
-            # Left arm
-            self.reachy.l_arm.l_shoulder_pitch: 0,
-            self.reachy.l_arm.l_shoulder_roll: 0,
-            self.reachy.l_arm.l_arm_yaw: 0,
-            self.reachy.l_arm.l_elbow_pitch: 0,
-            self.reachy.l_arm.l_forearm_yaw: 0,
-            self.reachy.l_arm.l_wrist_pitch: 0,
-            self.reachy.l_arm.l_wrist_roll: 0,
-            self.reachy.l_arm.l_gripper: 0,
-        }
+        joint_angles = dict.fromkeys(self.plan.joints, 0)
 
         self.reachy_goto(joint_angles, 1.0)
@@ -0,0 +1,133 @@
+from collections import deque
+import json
+import math
+
+ENCODING = None
+ENCODING_LOADED = False
+
+
+def get_encoding():
+    # tiktoken's encoding for exact token counts, None if unavailable. Loaded
+    # on first use, as tiktoken may download it (and fail when offline)
+
+    global ENCODING, ENCODING_LOADED
+
+    if not ENCODING_LOADED:
+        ENCODING_LOADED = True
+
+        try:
+            import tiktoken
+
+            ENCODING = tiktoken.get_encoding("o200k_base")
+
+        except Exception:
+            ENCODING = None
+
+    return ENCODING
+
+
+def estimate_tokens(text):
+    # Number of tokens in text, roughly 4 characters per token without tiktoken
+
+    encoding = get_encoding()
+
+    if encoding != None:
+        return len(encoding.encode(text))
+
+    return math.ceil(len(text) / 4)
+
+
+class ChatMemory:
+    """Conversation memory with both user and assistant messages.
+
+    Recent messages are kept in a bounded ring buffer. When the buffer is full,
+    or the messages exceed the token budget, the oldest ones are compacted
+    into a running summary that is sent as a system message instead.
+    """
+
+    def __init__(self, max_messages=10, token_budget=800):
+
+        self.max_messages = max_messages
+        self.token_budget = token_budget  # Tokens of summary and messages
+        self.summary_budget = token_budget // 4
+
+        self.messages = deque()
+        self.message_tokens = deque()
+        self.summary_lines = deque()
+        self.summary_tokens = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, role, content):
+
+        if not isinstance(content, str):
+            # Responses are stored the way ChatGPT is asked to format them
+            content = json.dumps(content, ensure_ascii=False)
+
+        self.messages.append({"role": role, "content": content})
+        self.message_tokens.append(estimate_tokens(content))
+
+        self.compact()
+
+    def tokens(self):
+        return sum(self.message_tokens) + self.summary_tokens
+
+    def compact(self):
+        # Move oldest messages into the summary until within bounds
+
+        while len(self.messages) > 1 and (
+            len(self.messages) > self.max_messages or self.tokens() > self.token_budget
+        ):
+            message = self.messages.popleft()
+            self.message_tokens.popleft()
+            self.summarize(message)
+
+    def summarize(self, message):
+        # Extractive summary, keeps the gist without calling the LLM
+
+        content = message["content"]
+
+        if message["role"] == "assistant":
+            try:
+                response = json.loads(content)
+                content = "%s (%s)" % (response["answer"], response["action"])
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        if len(content) > 120:
+            content = content[:117] + "..."
+
+        speaker = "Reachy" if message["role"] == "assistant" else "User"
+        line = speaker + ": " + content
+
+        self.summary_lines.append((line, estimate_tokens(line)))
+        self.summary_tokens += self.summary_lines[-1][1]
+
+        # Oldest lines of the summary are forgotten first
+        while len(self.summary_lines) > 1 and self.summary_tokens > self.summary_budget:
+            self.summary_tokens -= self.summary_lines.popleft()[1]
+
+    def context(self):
+        # Messages to send before the new user promt
+
+        context = []
+
+        if len(self.summary_lines) > 0:
+            context.append(
+                {
+                    "role": "system",
+                    "content": "Summary of earlier conversation:\n"
+                    + "\n".join(line for line, _ in self.summary_lines),
+                }
+            )
+
+        context.extend(self.messages)
+
+        return context
+
+    def clear(self):
+        self.messages.clear()
+        self.message_tokens.clear()
+        self.summary_lines.clear()
+        self.summary_tokens = 0
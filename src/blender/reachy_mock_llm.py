@@ -0,0 +1,214 @@
+"""Deterministic stand-in for an OpenAI compatible chat completions server.
+
+Answers a promt with an action picked by keywords, always the same for the
+same promt, after a configurable latency. So the promt -> action -> motion
+pipeline can be tested and benchmarked without network or API key. Runs
+inside Blender (the "Mock" LLM backend), or on its own:
+
+    python reachy_mock_llm.py --port 8000 --latency 0.5
+
+and then use http://localhost:8000/v1 as the base URL of the addon.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+# First keyword found in the promt decides the action, else ReachyShrug
+MOCK_KEYWORDS = [
+    (("hej", "hello", "hi", "farvel", "bye", "vink", "wave"), "ReachyWave"),
+    (("dans", "danse", "dance"), "ReachyDance"),
+    (("ja", "yes", "tak", "thanks"), "ReachyYes"),
+    (("nej", "no"), "ReachyNo"),
+]
+
+
+def mock_response(messages):
+    # Response to the last user message, only depends on its words
+
+    promt = ""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            promt = str(message.get("content", ""))
+            break
+
+    words = "".join(c if c.isalnum() else " " for c in promt.lower()).split()
+    action = "ReachyShrug"
+
+    for keywords, keyword_action in MOCK_KEYWORDS:
+        if any(word in keywords for word in words):
+            action = keyword_action
+            break
+
+    return {"action": action, "answer": "Mock svar på: " + promt}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass  # Keep Blender's console quiet
+
+    def do_POST(self):
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            messages = request["messages"]
+        except (ValueError, KeyError) as error:
+            self.send_error(400, str(error))
+            return
+
+        server = self.server
+        server.requests += 1
+
+        content = json.dumps(mock_response(messages), ensure_ascii=False)
+        model = request.get("model", "mock")
+
+        time.sleep(server.latency)
+
+        if request.get("stream"):
+            self.send_stream(content, model)
+        else:
+            self.send_completion(content, model)
+
+    def completion(self, model, kind, choice):
+        return {
+            "id": "chatcmpl-mock-%d" % self.server.requests,
+            "object": kind,
+            "created": int(time.time()),
+            "model": model,
+            "choices": [dict(index=0, **choice)],
+        }
+
+    def send_completion(self, content, model):
+
+        body = self.completion(
+            model,
+            "chat.completion",
+            {
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            },
+        )
+        body["usage"] = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
+        data = json.dumps(body).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, content, model):
+        # Server-sent events, a few characters per chunk like real tokens
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunk_size = self.server.chunk_size
+        chunks = [
+            content[i : i + chunk_size] for i in range(0, len(content), chunk_size)
+        ]
+
+        try:
+            for i, text in enumerate(chunks):
+                delta = {"content": text}
+                if i == 0:
+                    delta["role"] = "assistant"
+
+                self.send_event(
+                    self.completion(
+                        model,
+                        "chat.completion.chunk",
+                        {"delta": delta, "finish_reason": None},
+                    )
+                )
+                time.sleep(self.server.chunk_delay)
+
+            self.send_event(
+                self.completion(
+                    model,
+                    "chat.completion.chunk",
+                    {"delta": {}, "finish_reason": "stop"},
+                )
+            )
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client closed the stream, for example when cancelled
+
+    def send_event(self, body):
+        self.wfile.write(b"data: " + json.dumps(body).encode() + b"\n\n")
+        self.wfile.flush()
+
+
+class MockLLMServer:
+    """Mock chat completions server on a background thread.
+
+    latency: seconds before the response starts
+    chunk_delay: seconds between streamed chunks of chunk_size characters
+    port: 0 picks a free port, see base_url()
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.3, chunk_delay=0.02):
+
+        self.server = ThreadingHTTPServer((host, port), MockLLMHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.chunk_delay = chunk_delay
+        self.server.chunk_size = 4
+        self.server.requests = 0
+
+        self.thread = None
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/v1" % (host, port)
+
+    def start(self):
+
+        if self.thread != None:
+            return
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        if self.thread == None:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.thread = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    mock = MockLLMServer(args.host, args.port, args.latency, args.chunk_delay)
+    print("Mock LLM server at " + mock.base_url())
+
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.server.server_close()
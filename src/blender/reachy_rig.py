@@ -0,0 +1,219 @@
+import functools
+import json
+import numpy as np
+import os
+
+DEFAULT_MAPPING_PATH = os.path.join(os.path.dirname(__file__), "joint_mapping.json")
+
+# Rotation axis of a bone, "auto" uses the only axis not locked in Blender
+AXES = {"auto": -1, "x": 0, "y": 1, "z": 2}
+
+# Blender clamps near-singular matrices with this threshold before decomposing
+EULER_EPSILON = 16.0 * np.finfo(np.float32).eps
+
+
+def matrices_to_euler_xyz(matrices):
+    """Vectorized equivalent of mathutils.Matrix.to_euler() (XYZ order),
+    for a stack of (N, 4, 4) or (N, 3, 3) row-major matrices.
+    Returns an (N, 3) array of angles in radians.
+    """
+    rot = np.asarray(matrices, dtype=np.float64)[:, :3, :3]
+
+    # Normalize axis vectors (columns), removing scale like Blender does
+    rot = rot / np.linalg.norm(rot, axis=1, keepdims=True)
+
+    cy = np.hypot(rot[:, 0, 0], rot[:, 1, 0])
+
+    # Blender computes two equivalent solutions, and keeps the smallest one
+    eul1 = np.stack(
+        (
+            np.arctan2(rot[:, 2, 1], rot[:, 2, 2]),
+            np.arctan2(-rot[:, 2, 0], cy),
+            np.arctan2(rot[:, 1, 0], rot[:, 0, 0]),
+        ),
+        axis=-1,
+    )
+    eul2 = np.stack(
+        (
+            np.arctan2(-rot[:, 2, 1], -rot[:, 2, 2]),
+            np.arctan2(-rot[:, 2, 0], -cy),
+            np.arctan2(-rot[:, 1, 0], -rot[:, 0, 0]),
+        ),
+        axis=-1,
+    )
+
+    use_eul2 = np.abs(eul1).sum(axis=-1) > np.abs(eul2).sum(axis=-1)
+    eul = np.where(use_eul2[:, None], eul2, eul1)
+
+    # Gimbal lock, the z rotation is folded into x
+    singular = cy <= EULER_EPSILON
+    if singular.any():
+        eul[singular, 0] = np.arctan2(-rot[singular, 1, 2], rot[singular, 1, 1])
+        eul[singular, 1] = np.arctan2(-rot[singular, 2, 0], cy[singular])
+        eul[singular, 2] = 0.0
+
+    return eul
+
+
+def bone_axes(pose_bones, axes):
+    # Rotation axis of each bone, defaulting to the unconstrained one
+
+    return np.array(
+        [
+            (
+                axis
+                if axis >= 0
+                else np.flatnonzero(np.array(bone.lock_rotation) == False)[0]
+            )
+            for bone, axis in zip(pose_bones, axes)
+        ]
+    )
+
+
+class RigAngleExtractor:
+    """Extracts the angles of several bones of an armature in one NumPy pass.
+    Everything that only depends on the rest pose of the rig (bone indices,
+    rotation axis, inverse rest matrices) is computed once, so each call only
+    reads the current pose matrices.
+    """
+
+    def __init__(self, armature, bone_names, axes):
+
+        self.pointer = armature.as_pointer()
+
+        pose_bones = armature.pose.bones
+        names = pose_bones.keys()
+        self.bone_count = len(names)
+
+        bones = [pose_bones[name] for name in bone_names]
+        count = len(bones)
+
+        # Indices into the flat buffer filled by foreach_get
+        self.bone_index = np.array([names.index(bone.name) for bone in bones])
+
+        self.has_parent = np.array(
+            [bone.parent != None and bone.parent.name != "Root" for bone in bones]
+        )
+        self.parent_index = np.array(
+            [
+                names.index(bone.parent.name) if has_parent else index
+                for bone, has_parent, index in zip(
+                    bones, self.has_parent, self.bone_index
+                )
+            ]
+        )
+
+        self.axes = bone_axes(bones, axes)
+
+        # Constant part of the bone space matrix: rest_inv @ par_rest
+        rest_inv = np.array(
+            [np.array(bone.bone.matrix_local.inverted()) for bone in bones]
+        )
+        par_rest = np.tile(np.identity(4), (count, 1, 1))
+        for i, bone in enumerate(bones):
+            if self.has_parent[i]:
+                par_rest[i] = np.array(bone.parent.bone.matrix_local)
+
+        self.rest_offset = rest_inv @ par_rest
+
+        self.buffer = np.empty(self.bone_count * 16, dtype=np.float32)
+        self.rows = np.arange(count)
+
+    def is_valid_for(self, armature):
+        # Rebuild when the armature is switched or its bones are changed
+        return (
+            armature.as_pointer() == self.pointer
+            and len(armature.pose.bones) == self.bone_count
+        )
+
+    def angles(self, armature):
+        # Read all pose matrices in one call (column-major, as stored by Blender)
+        armature.pose.bones.foreach_get("matrix", self.buffer)
+        matrices = self.buffer.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+        pose = matrices[self.bone_index]
+
+        parent_inv = np.linalg.inv(matrices[self.parent_index])
+        parent_inv[~self.has_parent] = np.identity(4)
+
+        # Matrix of each bone in its own transform space
+        local = self.rest_offset @ (parent_inv @ pose)
+
+        eul = matrices_to_euler_xyz(local)
+
+        return np.rad2deg(eul[self.rows, self.axes])
+
+
+def load_joint_mapping(file_path=DEFAULT_MAPPING_PATH):
+    # Read and validate table of bones and the Reachy joints they control
+
+    with open(file_path, "r", encoding="utf-8") as file:
+        mapping = json.load(file)
+
+    entries = mapping.get("joints", [])
+
+    if len(entries) == 0:
+        raise ValueError("No joints in mapping '%s'" % file_path)
+
+    for entry in entries:
+        if "bone" not in entry or "joint" not in entry:
+            raise ValueError("Mapping entry needs 'bone' and 'joint': " + str(entry))
+
+        if entry.get("axis", "auto") not in AXES:
+            raise ValueError("Unknown axis in mapping entry: " + str(entry))
+
+    return entries
+
+
+class JointPlan:
+    """Joint mapping compiled into flat arrays, in the order of the mapping table.
+    Bone side data is available right away, Reachy joints are resolved by
+    compile() once a robot is connected.
+    """
+
+    def __init__(self, entries):
+
+        self.entries = entries
+        self.bone_names = [entry["bone"] for entry in entries]
+        self.joint_paths = [entry["joint"] for entry in entries]
+        self.joint_names = [path.split(".")[-1] for path in self.joint_paths]
+
+        self.axes = np.array([AXES[entry.get("axis", "auto")] for entry in entries])
+        self.signs = np.array([entry.get("sign", 1) for entry in entries], dtype=float)
+        self.offsets = np.array(
+            [entry.get("offset", 0.0) for entry in entries], dtype=float
+        )
+
+        # Per joint deadband (degrees), NaN uses the global deadband
+        self.deadbands = np.array(
+            [entry.get("deadband", np.nan) for entry in entries], dtype=float
+        )
+
+        limits = [entry.get("limits") or [-np.inf, np.inf] for entry in entries]
+        self.lower = np.array([limit[0] for limit in limits], dtype=float)
+        self.upper = np.array([limit[1] for limit in limits], dtype=float)
+
+        self.joints = []
+
+    def __len__(self):
+        return len(self.bone_names)
+
+    def fingerprint(self):
+        # Identifies the mapping, used in cache keys of baked trajectories
+        return json.dumps(self.entries, sort_keys=True)
+
+    def compile(self, reachy):
+        # Resolve joint paths like "r_arm.r_elbow_pitch" on the Reachy instance
+
+        self.joints = [
+            functools.reduce(getattr, path.split("."), reachy)
+            for path in self.joint_paths
+        ]
+
+    def joint_deadbands(self, deadband):
+        return np.where(np.isnan(self.deadbands), deadband, self.deadbands)
+
+    def joint_angles(self, bone_angles):
+        # Convert bone angles (degrees) to joint goal positions
+
+        return np.clip(bone_angles * self.signs + self.offsets, self.lower, self.upper)
@@ -0,0 +1,309 @@
+import numpy as np
+import threading
+import time
+
+from .reachy_trajectory import minimum_jerk
+
+
+class Mailbox:
+    """Size-1 mailbox where the latest posted item wins. Items that are
+    replaced before being taken are dropped instead of queued.
+
+    Counters:
+    - sent: items reported as sent by the consumer
+    - dropped: items replaced by a newer one before being taken
+    - coalesced: taken items that replaced at least one older item
+    """
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.item = None
+        self.has_item = False
+        self.closed = False
+
+        self.replaced = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, item):
+
+        with self.condition:
+            if self.has_item:
+                self.dropped += 1
+                self.replaced += 1
+
+            self.item = item
+            self.has_item = True
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # Wait for an item, returns None on timeout or when closed
+
+        with self.condition:
+            if not self.has_item and not self.closed:
+                self.condition.wait(timeout)
+
+            if not self.has_item:
+                return None
+
+            if self.replaced > 0:
+                self.coalesced += 1
+
+            item = self.item
+            self.item = None
+            self.has_item = False
+            self.replaced = 0
+
+            return item
+
+    def mark_sent(self):
+        with self.condition:
+            self.sent += 1
+
+    def clear(self):
+        with self.condition:
+            self.item = None
+            self.has_item = False
+            self.replaced = 0
+
+    def open(self):
+        with self.condition:
+            self.closed = False
+
+    def close(self):
+        # Wake up consumer waiting in get()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+            }
+
+
+class DeltaFilter:
+    """Keeps the last sent joint vector, and selects the joints that moved
+    more than their deadband (degrees) since they were last sent.
+    """
+
+    def __init__(self, deadband=0.5):
+
+        self.deadband = deadband
+        self.last = None
+        self.skipped = 0
+
+    def reset(self, deadband=None):
+        # Next call sends every joint
+
+        if deadband is not None:
+            self.deadband = deadband
+
+        self.last = None
+
+    def changed(self, positions):
+        # Indices of joints to send, marked as sent
+
+        positions = np.asarray(positions, dtype=float)
+
+        if self.last is None or len(self.last) != len(positions):
+            self.last = positions.copy()
+            return np.arange(len(positions))
+
+        changed = np.flatnonzero(np.abs(positions - self.last) > self.deadband)
+
+        if len(changed) == 0:
+            self.skipped += 1
+
+        self.last[changed] = positions[changed]
+
+        return changed
+
+
+class StreamSender:
+    """Single long-lived thread writing joint targets directly to Reachy's
+    goal positions at a fixed rate. Blender posts the newest targets from the
+    main thread, the sender only ever writes the most recent ones.
+    """
+
+    def __init__(self):
+
+        self.rate = 30.0  # Hz
+        self.thread = None
+        self.running = threading.Event()
+        self.mailbox = Mailbox()
+        self.filter = DeltaFilter()
+
+    def is_running(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def start(self, joints, rate=30.0, deadband=0.5):
+
+        if self.is_running():
+            return
+
+        self.rate = rate
+        self.mailbox.clear()
+        self.filter.reset(deadband)
+
+        # Goal positions are only followed by stiff motors
+        for joint in joints:
+            joint.compliant = False
+
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.running.clear()
+
+        if self.thread != None and self.thread != threading.current_thread():
+            self.thread.join()
+
+        self.thread = None
+
+    def post(self, joints, positions):
+        # Replace pending target, older targets are never sent
+        self.mailbox.put((joints, positions))
+
+    def stats(self):
+        stats = self.mailbox.stats()
+        stats["skipped"] = self.filter.skipped
+
+        return stats
+
+    def run(self):
+
+        period = 1.0 / self.rate
+        next_time = time.perf_counter()
+
+        while self.running.is_set():
+
+            target = self.mailbox.get(timeout=0)
+
+            if target != None:
+                joints, positions = target
+
+                # Only write joints that moved, skip the tick if none did
+                changed = self.filter.changed(positions)
+
+                for i in changed:
+                    joints[i].goal_position = float(positions[i])
+
+                if len(changed) > 0:
+                    self.mailbox.mark_sent()
+
+            next_time += period
+            delay = next_time - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Running behind, don't try to catch up on missed ticks
+                next_time = time.perf_counter()
+
+
+class TrajectoryPlayer:
+    """Plays a trajectory on a worker thread, by writing interpolated goal
+    positions at a fixed rate. Since no blocking goto is involved, playback
+    can be paused, resumed and cancelled mid-motion.
+    """
+
+    def __init__(self):
+
+        self.rate = 50.0  # Hz
+        self.approach_duration = 1.0  # Seconds to reach first pose
+
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.resumed = threading.Event()
+
+        self.trajectory = None
+        self.progress = 0.0
+        self.on_finished = None
+
+    def is_playing(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def is_paused(self):
+        return self.is_playing() and not self.resumed.is_set()
+
+    def play(self, trajectory, joints, on_finished=None):
+
+        self.cancel()
+
+        self.trajectory = trajectory
+        self.progress = 0.0
+        self.on_finished = on_finished
+
+        self.cancelled.clear()
+        self.resumed.set()
+
+        # Goal positions are only followed by stiff motors
+        for joint in joints:
+            joint.compliant = False
+
+        self.thread = threading.Thread(target=self.run, args=[joints], daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+
+        self.cancelled.set()
+        self.resumed.set()
+
+        if self.thread != None and self.thread != threading.current_thread():
+            self.thread.join()
+
+        self.thread = None
+
+    def run(self, joints):
+
+        trajectory = self.trajectory
+        period = 1.0 / self.rate
+
+        start = np.array([joint.present_position for joint in joints])
+        approach = np.asarray(trajectory.angles[0], dtype=float) - start
+        total = self.approach_duration + trajectory.duration()
+
+        elapsed = 0.0
+        time_prev = time.perf_counter()
+
+        while not self.cancelled.is_set() and elapsed < total:
+
+            if not self.resumed.is_set():
+                # Joints hold their last goal position while paused
+                self.resumed.wait()
+                time_prev = time.perf_counter()
+                continue
+
+            time_now = time.perf_counter()
+            elapsed = min(elapsed + time_now - time_prev, total)
+            time_prev = time_now
+
+            if elapsed < self.approach_duration:
+                s = elapsed / self.approach_duration
+                positions = start + approach * minimum_jerk(s)
+            else:
+                positions = trajectory.sample(elapsed - self.approach_duration)
+
+            for joint, position in zip(joints, positions.tolist()):
+                joint.goal_position = position
+
+            self.progress = elapsed / total if total > 0 else 1.0
+
+            self.cancelled.wait(period)
+
+        if self.on_finished != None:
+            self.on_finished()
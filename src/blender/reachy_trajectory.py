@@ -0,0 +1,484 @@
+import hashlib
+import numpy as np
+import os
+
+from .reachy_cache import LRUCache, atomic_write
+from .reachy_rig import bone_axes, matrices_to_euler_xyz
+
+# Rotation property and rest values per rotation mode, others are Euler
+ROTATION_CHANNELS = {
+    "QUATERNION": ("rotation_quaternion", (1.0, 0.0, 0.0, 0.0)),
+    "AXIS_ANGLE": ("rotation_axis_angle", (0.0, 0.0, 1.0, 0.0)),
+}
+EULER_CHANNELS = ("rotation_euler", (0.0, 0.0, 0.0))
+
+
+def minimum_jerk(s):
+    # Minimum jerk profile, from 0 to 1 with zero velocity and acceleration at ends
+    return s * s * s * (10.0 - 15.0 * s + 6.0 * s * s)
+
+
+class Trajectory:
+    """Joint angles sampled over time, baked from an action.
+
+    times: (frames,) seconds since the first sample
+    angles: (frames, joints) joint goal positions in degrees
+    rate: samples per second, or None if sampled at keyframes
+    """
+
+    def __init__(self, times, angles, joint_names, rate=None):
+
+        self.times = np.asarray(times, dtype=np.float64)
+        self.angles = np.asarray(angles, dtype=np.float32)
+        self.joint_names = list(joint_names)
+        self.rate = rate
+
+    def __len__(self):
+        return len(self.times)
+
+    def duration(self):
+        return float(self.times[-1]) if len(self.times) > 0 else 0.0
+
+    def sample(self, t):
+        # Joint angles at time t, minimum jerk between keyframes, else linear
+
+        i = np.searchsorted(self.times, t, side="right")
+
+        if i <= 0:
+            return self.angles[0]
+        if i >= len(self.times):
+            return self.angles[-1]
+
+        s = (t - self.times[i - 1]) / (self.times[i] - self.times[i - 1])
+
+        if self.rate == None:
+            s = minimum_jerk(s)
+
+        return self.angles[i - 1] + (self.angles[i] - self.angles[i - 1]) * s
+
+    def save(self, file_path):
+        atomic_write(
+            file_path,
+            lambda temp_path: np.savez(
+                temp_path,
+                times=self.times,
+                angles=self.angles,
+                joint_names=np.array(self.joint_names),
+                rate=np.nan if self.rate == None else self.rate,
+            ),
+            ".tmp.npz",
+        )
+
+    @classmethod
+    def load(cls, file_path):
+
+        with np.load(file_path) as data:
+            rate = float(data["rate"])
+
+            return cls(
+                data["times"],
+                data["angles"],
+                data["joint_names"].tolist(),
+                None if np.isnan(rate) else rate,
+            )
+
+
+def keyframe_frames(action):
+    # Sorted frames of all keyframes in the action
+
+    frames = [np.empty(0)]
+
+    for fcurve in action.fcurves:
+        co = np.empty(len(fcurve.keyframe_points) * 2)
+        fcurve.keyframe_points.foreach_get("co", co)
+        frames.append(co[0::2])
+
+    return np.unique(np.concatenate(frames))
+
+
+def sample_frames(action, fps, rate=None):
+    # Frames to sample, either every keyframe or at a fixed rate
+
+    keyframes = keyframe_frames(action)
+
+    if rate == None or len(keyframes) < 2:
+        return keyframes
+
+    step = fps / rate
+    frames = np.arange(keyframes[0], keyframes[-1], step)
+
+    return np.append(frames, keyframes[-1])
+
+
+def axis_matrices(axis, angles):
+    # Rotation matrices around a single axis, shape (N, 3, 3)
+
+    cos, sin = np.cos(angles), np.sin(angles)
+    i, j = [k for k in range(3) if k != axis]
+
+    matrices = np.zeros((len(angles), 3, 3))
+    matrices[:, axis, axis] = 1.0
+    matrices[:, i, i] = cos
+    matrices[:, j, j] = cos
+    matrices[:, i, j] = -sin if axis != 1 else sin
+    matrices[:, j, i] = sin if axis != 1 else -sin
+
+    return matrices
+
+
+def rotation_matrices(mode, values):
+    # Rotation matrices from F-curve values of a given Blender rotation mode
+
+    if mode == "QUATERNION":
+        q = values / np.linalg.norm(values, axis=1, keepdims=True)
+        w, x, y, z = q.T
+
+        return np.stack(
+            (
+                np.stack(
+                    (1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)),
+                    -1,
+                ),
+                np.stack(
+                    (2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)),
+                    -1,
+                ),
+                np.stack(
+                    (2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)),
+                    -1,
+                ),
+            ),
+            axis=1,
+        )
+
+    if mode == "AXIS_ANGLE":
+        angle = values[:, 0]
+        axis = values[:, 1:] / np.linalg.norm(values[:, 1:], axis=1, keepdims=True)
+
+        # Rodrigues' rotation formula
+        cross = np.zeros((len(values), 3, 3))
+        cross[:, 0, 1], cross[:, 0, 2] = -axis[:, 2], axis[:, 1]
+        cross[:, 1, 0], cross[:, 1, 2] = axis[:, 2], -axis[:, 0]
+        cross[:, 2, 0], cross[:, 2, 1] = -axis[:, 1], axis[:, 0]
+
+        sin = np.sin(angle)[:, None, None]
+        cos = np.cos(angle)[:, None, None]
+
+        return np.identity(3) + sin * cross + (1 - cos) * (cross @ cross)
+
+    # Euler, "XYZ" applies X first, so the matrix is Rz @ Ry @ Rx
+    matrices = np.tile(np.identity(3), (len(values), 1, 1))
+
+    for axis_name in mode:
+        axis = "XYZ".index(axis_name)
+        matrices = axis_matrices(axis, values[:, axis]) @ matrices
+
+    return matrices
+
+
+def evaluate_rotation(action, pose_bone, frames):
+    # Evaluate rotation F-curves of a bone, unanimated channels stay at rest
+    # (not the current pose, so the result only depends on the action)
+
+    prop, rest = ROTATION_CHANNELS.get(pose_bone.rotation_mode, EULER_CHANNELS)
+    data_path = pose_bone.path_from_id(prop)
+
+    values = np.empty((len(frames), len(rest)))
+
+    for index in range(len(rest)):
+        fcurve = action.fcurves.find(data_path, index=index)
+
+        if fcurve == None:
+            values[:, index] = rest[index]
+        else:
+            values[:, index] = [fcurve.evaluate(frame) for frame in frames]
+
+    return values
+
+
+def has_constraints(armature):
+    # Constraints (like IK) make bone angles depend on more than their F-curves
+
+    return any(
+        constraint.enabled and constraint.influence > 0
+        for pose_bone in armature.pose.bones
+        for constraint in pose_bone.constraints
+    )
+
+
+def empty_trajectory(plan, rate=None):
+    # Trajectory of an action without keyframes
+    return Trajectory(np.empty(0), np.empty((0, len(plan))), plan.joint_names, rate)
+
+
+def bake_action(armature, action, plan, fps, rate=None):
+    """Bakes joint angles of all mapped bones directly from the action's
+    F-curves, without evaluating the scene. Only valid for rigs without
+    constraints, see bake_action_evaluated() otherwise.
+    """
+    frames = sample_frames(action, fps, rate)
+
+    if len(frames) == 0:
+        return empty_trajectory(plan, rate)
+
+    pose_bones = [armature.pose.bones[name] for name in plan.bone_names]
+    axes = bone_axes(pose_bones, plan.axes)
+
+    bone_angles = np.empty((len(frames), len(pose_bones)))
+
+    for i, (pose_bone, axis) in enumerate(zip(pose_bones, axes)):
+        values = evaluate_rotation(action, pose_bone, frames)
+        matrices = rotation_matrices(pose_bone.rotation_mode, values)
+        bone_angles[:, i] = np.rad2deg(matrices_to_euler_xyz(matrices)[:, axis])
+
+    return Trajectory(
+        (frames - frames[0]) / fps,
+        plan.joint_angles(bone_angles),
+        plan.joint_names,
+        rate,
+    )
+
+
+def bake_action_evaluated(scene, armature, action, plan, get_angles, rate=None):
+    """Bakes joint angles by evaluating the scene at every sampled frame,
+    for rigs where constraints affect the mapped bones. get_angles(armature)
+    returns the joint angles of the current pose.
+    """
+    fps = scene.render.fps
+    frames = sample_frames(action, fps, rate)
+
+    if len(frames) == 0:
+        return empty_trajectory(plan, rate)
+
+    frame_current = scene.frame_current
+
+    # Action is assigned temporarily, to also bake actions not in use
+    action_current = armature.animation_data.action
+    armature.animation_data.action = action
+
+    angles = np.empty((len(frames), len(plan)))
+
+    try:
+        for i, frame in enumerate(frames):
+            scene.frame_set(int(frame), subframe=float(frame % 1.0))
+            angles[i] = get_angles(armature)
+
+    finally:
+        armature.animation_data.action = action_current
+        scene.frame_set(frame_current)
+
+    return Trajectory((frames - frames[0]) / fps, angles, plan.joint_names, rate)
+
+
+def bake(scene, armature, action, plan, get_angles, rate=None):
+    # Bake action for the armature, using the fastest valid method
+
+    if has_constraints(armature):
+        return bake_action_evaluated(scene, armature, action, plan, get_angles, rate)
+
+    return bake_action(armature, action, plan, scene.render.fps, rate)
+
+
+def hash_fcurves(digest, action):
+    # Add keyframes and settings of all F-curves of the action to digest
+
+    fcurves = sorted(
+        action.fcurves, key=lambda fcurve: (fcurve.data_path, fcurve.array_index)
+    )
+
+    for fcurve in fcurves:
+        points = fcurve.keyframe_points
+        digest.update(
+            repr(
+                (
+                    fcurve.data_path,
+                    fcurve.array_index,
+                    fcurve.mute,
+                    fcurve.extrapolation,
+                    len(fcurve.modifiers),
+                    [point.interpolation for point in points],
+                )
+            ).encode()
+        )
+
+        for prop in ("co", "handle_left", "handle_right"):
+            buffer = np.empty(len(points) * 2, dtype=np.float32)
+            points.foreach_get(prop, buffer)
+            digest.update(buffer)
+
+
+def constraint_settings(constraint):
+    # Values of all settings of a constraint, targets by name
+
+    values = []
+
+    for prop in constraint.bl_rna.properties:
+        if prop.type == "COLLECTION" or prop.identifier in ("rna_type", "active"):
+            continue
+
+        value = getattr(constraint, prop.identifier)
+
+        if prop.type == "POINTER":
+            value = getattr(value, "name", None)
+        elif getattr(prop, "is_array", False):
+            value = tuple(value)
+
+        values.append((prop.identifier, value))
+
+    return values
+
+
+def hash_constraints(digest, armature, action):
+    """Add everything constraints make the pose depend on, besides the
+    action: constraint settings, and the transforms of targets and poles
+    that are not animated by the action itself (like an IK target moved by
+    hand). Target objects animated by their own action add its F-curves.
+    """
+    animated_bones = {
+        fcurve.data_path.split('"')[1]
+        for fcurve in action.fcurves
+        if fcurve.data_path.startswith("pose.bones[")
+    }
+
+    for pose_bone in armature.pose.bones:
+        for constraint in pose_bone.constraints:
+            digest.update(
+                repr((pose_bone.name, constraint_settings(constraint))).encode()
+            )
+
+            for target_prop, bone_prop in (
+                ("target", "subtarget"),
+                ("pole_target", "pole_subtarget"),
+            ):
+                target = getattr(constraint, target_prop, None)
+
+                if target == None:
+                    continue
+
+                if (
+                    target != armature
+                    and target.animation_data != None
+                    and target.animation_data.action != None
+                ):
+                    # Its transform changes with the frame, the action doesn't
+                    hash_fcurves(digest, target.animation_data.action)
+                else:
+                    digest.update(np.array(target.matrix_world, dtype=np.float32))
+
+                bone_name = getattr(constraint, bone_prop, "")
+                if target.type != "ARMATURE" or bone_name not in target.pose.bones:
+                    continue
+
+                if target == armature and bone_name in animated_bones:
+                    continue
+
+                digest.update(
+                    np.array(
+                        target.pose.bones[bone_name].matrix_basis, dtype=np.float32
+                    )
+                )
+
+
+def action_hash(armature, action, plan, fps, rate=None):
+    # Hash of everything a baked trajectory depends on
+
+    digest = hashlib.sha1()
+    digest.update(plan.fingerprint().encode())
+    digest.update(repr((fps, rate, has_constraints(armature))).encode())
+
+    # Rest pose and rotation setup of the mapped bones
+    for name in plan.bone_names:
+        pose_bone = armature.pose.bones[name]
+        digest.update(np.array(pose_bone.bone.matrix_local, dtype=np.float32))
+        digest.update(
+            repr((pose_bone.rotation_mode, tuple(pose_bone.lock_rotation))).encode()
+        )
+
+    # Evaluated bakes also depend on constraints and their targets
+    if has_constraints(armature):
+        hash_constraints(digest, armature, action)
+
+    # Animation data
+    hash_fcurves(digest, action)
+
+    return digest.hexdigest()
+
+
+class TrajectoryCache:
+    """Baked trajectories, keyed by action_hash(). Kept in memory, and as .npz
+    files in directory (if given) so they survive Blender restarts. Both keep
+    the least recently used max_size trajectories.
+    """
+
+    def __init__(self, directory=None, max_size=128):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.trajectories = LRUCache(max_size)
+
+    def file_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+
+        trajectory = self.trajectories.get(key)
+
+        if trajectory != None:
+            return trajectory
+
+        if self.directory == None or not os.path.exists(self.file_path(key)):
+            return None
+
+        try:
+            trajectory = Trajectory.load(self.file_path(key))
+
+            # Modification time orders files by use, see prune()
+            os.utime(self.file_path(key))
+
+        except (OSError, ValueError, KeyError) as error:
+            print("Could not load cached trajectory: " + str(error))
+            return None
+
+        self.trajectories.put(key, trajectory)
+
+        return trajectory
+
+    def put(self, key, trajectory):
+
+        self.trajectories.put(key, trajectory)
+
+        if self.directory != None:
+            try:
+                trajectory.save(self.file_path(key))
+            except OSError as error:
+                print("Could not save cached trajectory: " + str(error))
+
+            self.prune()
+
+    def prune(self):
+        # Remove the least recently used files, beyond max_size
+
+        try:
+            file_paths = [
+                entry.path
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(".npz") and not entry.name.endswith(".tmp.npz")
+            ]
+            file_paths.sort(key=os.path.getmtime)
+
+            for file_path in file_paths[: max(len(file_paths) - self.max_size, 0)]:
+                os.remove(file_path)
+
+        except OSError as error:
+            print("Could not prune trajectory cache: " + str(error))
+
+    def get_or_bake(self, scene, armature, action, plan, get_angles, rate=None):
+
+        key = action_hash(armature, action, plan, scene.render.fps, rate)
+        trajectory = self.get(key)
+
+        if trajectory == None:
+            trajectory = bake(scene, armature, action, plan, get_angles, rate)
+            self.put(key, trajectory)
+
+        return trajectory
@@ -0,0 +1,346 @@
+from abc import ABC, abstractmethod
+import hashlib
+import io
+import numpy as np
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+import sounddevice as sd
+
+from .reachy_audio import pcm_to_float32, read_wav
+from .reachy_cache import LRUCache, atomic_write
+
+
+def split_sentences(text):
+    # "Hej! Hvordan kan jeg hjælpe?" -> ["Hej!", "Hvordan kan jeg hjælpe?"]
+    return [
+        sentence for sentence in re.split(r"(?<=[.!?:;])\s+", text.strip()) if sentence
+    ]
+
+
+class TTSEngine(ABC):
+    """Text to speech engine used by ReachyTTS. synthesize() returns
+    (samples, samplerate), with mono float32 samples in the range [-1, 1].
+    """
+
+    name = "TTS"
+
+    def is_available(self):
+        return True
+
+    @abstractmethod
+    def synthesize(self, text, language): ...
+
+
+class GTTSEngine(TTSEngine):
+    # Google Translate's text to speech, needs network
+
+    name = "gTTS"
+
+    def synthesize(self, text, language):
+
+        from gtts import gTTS
+        import pydub
+
+        # Load into .mp3 format
+        mp3_fp = io.BytesIO()
+        gTTS(text=text, lang=language).write_to_fp(mp3_fp)
+        mp3_fp.seek(0)  # Set buffer position at beginning
+
+        # Decode mp3 data, and view its raw PCM data as mono float32
+        audio = pydub.AudioSegment.from_file(mp3_fp, format="mp3")
+        samples = pcm_to_float32(audio.raw_data, audio.sample_width, audio.channels)
+
+        return samples, audio.frame_rate
+
+
+class EspeakEngine(TTSEngine):
+    # eSpeak NG, runs offline, must be installed and on PATH
+
+    name = "eSpeak"
+
+    def __init__(self, voices=None):
+
+        self.executable = shutil.which("espeak-ng") or shutil.which("espeak")
+        self.voices = voices or {}  # Language: voice, if not the language code
+
+    def is_available(self):
+        return self.executable != None
+
+    def synthesize(self, text, language):
+
+        if self.executable == None:
+            raise RuntimeError("eSpeak NG is not installed")
+
+        voice = self.voices.get(language, language)
+        result = subprocess.run(
+            [self.executable, "-v", voice, "--stdout", text],
+            capture_output=True,
+            check=True,
+        )
+
+        return read_wav(io.BytesIO(result.stdout))
+
+
+class ReachyTTS:
+    """Text to speech with a cache of synthesized audio, kept in memory
+    (least recently used) and as .npz files in directory (if given), keyed
+    by engine, language and text. Repeated answers start playing right away
+    and don't need network, see also presynthesize().
+    """
+
+    def __init__(self, engine=None, directory=None, max_size=64):
+
+        self.engine = engine if engine != None else GTTSEngine()
+        self.directory = directory
+        self.memory = LRUCache(max_size)
+        self.player = None  # SpeechPlayer, created when first speaking
+
+        # Optional hooks, for example to gesture along with speech.
+        # prepare_sentence(key, samples, samplerate) runs after synthesis,
+        # and its result is passed to on_sentence() on the audio thread when
+        # the sentence starts playing, so on_sentence() must not block
+        self.prepare_sentence = None
+        self.on_sentence = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, language):
+        return hashlib.sha1(
+            repr((self.engine.name, language, text.strip())).encode()
+        ).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+
+        if self.directory == None or not os.path.exists(self.file_path(key)):
+            return None
+
+        try:
+            with np.load(self.file_path(key)) as data:
+                return data["samples"], int(data["samplerate"])
+
+        except (OSError, ValueError, KeyError) as error:
+            print("Could not load cached speech: " + str(error))
+            return None
+
+    def save(self, key, audio):
+
+        if self.directory == None:
+            return
+
+        try:
+            atomic_write(
+                self.file_path(key),
+                lambda temp_path: np.savez(
+                    temp_path, samples=audio[0], samplerate=audio[1]
+                ),
+                ".tmp.npz",
+            )
+
+        except OSError as error:
+            print("Could not save cached speech: " + str(error))
+
+    def synthesize(self, text, language="en"):
+        # (samples, samplerate) of text, from cache if synthesized before
+
+        key = self.key(text, language)
+        audio = self.memory.get(key)
+
+        if audio == None:
+            audio = self.load(key)
+
+        if audio == None:
+            self.misses += 1
+
+            samples, samplerate = self.engine.synthesize(text, language)
+            audio = (np.asarray(samples, dtype=np.float32), samplerate)
+            self.save(key, audio)
+
+        else:
+            self.hits += 1
+
+        self.memory.put(key, audio)
+
+        return audio
+
+    def prepare(self, text, language="en"):
+        # Synthesized audio of text, and the result of prepare_sentence()
+
+        samples, samplerate = self.synthesize(text, language)
+
+        prepared = None
+        if self.prepare_sentence != None:
+            prepared = self.prepare_sentence(
+                self.key(text, language), samples, samplerate
+            )
+
+        return samples, samplerate, prepared
+
+    def speak(self, text, language="en"):
+        # Plays text sentence by sentence, interrupting what is playing
+
+        if len(text) == 0:
+            return
+
+        if self.player == None:
+            self.player = SpeechPlayer(self)
+
+        self.player.play(split_sentences(text), language)
+
+    def stop(self):
+
+        if self.player != None:
+            self.player.close()
+            self.player = None
+
+    def presynthesize(self, texts, language="en"):
+        # Synthesizes texts in the background, so they are cached when needed.
+        # Split like speak() does, so the cached sentences are found
+
+        def worker():
+            for text in texts:
+                for sentence in split_sentences(text):
+                    try:
+                        self.prepare(sentence, language)
+                    except Exception as error:
+                        print("Could not synthesize speech: " + str(error))
+                        return
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        return thread
+
+
+class SpeechPlayer:
+    """Plays sentences through a single persistent output stream, while the
+    next sentences are synthesized. Time to first audio only depends on the
+    first sentence. At most max_queued synthesized sentences wait to be
+    played, so synthesis doesn't run far ahead of playback.
+    """
+
+    def __init__(self, tts, max_queued=2):
+
+        self.tts = tts
+
+        self.sentences = queue.Queue()  # (generation, sentence, language)
+        # (generation, samples, prepared)
+        self.audio = queue.Queue(maxsize=max_queued)
+
+        # Bumped by play(), older sentences and audio are skipped
+        self.generation = 0
+
+        self.stream = None
+        self.chunk = None  # Samples being played, and position in them
+        self.chunk_position = 0
+        self.chunk_generation = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def play(self, sentences, language):
+
+        self.generation += 1
+
+        for sentence in sentences:
+            self.sentences.put((self.generation, sentence, language))
+
+    def run(self):
+        # Synthesis thread, feeds the output stream
+
+        while True:
+            generation, sentence, language = self.sentences.get()
+
+            if generation == None:
+                return  # Closed
+
+            if generation != self.generation:
+                continue
+
+            try:
+                samples, samplerate, prepared = self.tts.prepare(sentence, language)
+            except Exception as error:
+                print("Could not synthesize speech: " + str(error))
+                continue
+
+            self.open_stream(samplerate)
+
+            # Blocks while max_queued sentences wait, stale ones are dropped
+            # by the stream callback so this never blocks for long
+            self.audio.put((generation, samples, prepared))
+
+    def open_stream(self, samplerate):
+
+        if self.stream != None and self.stream.samplerate == samplerate:
+            return
+
+        if self.stream != None:
+            # Another engine was selected, finish playing at the old rate
+            while not self.audio.empty() or (
+                self.chunk is not None and self.chunk_position < len(self.chunk)
+            ):
+                time.sleep(0.01)
+
+            self.stream.close()
+
+        self.stream = sd.OutputStream(
+            samplerate=samplerate,
+            channels=1,
+            dtype="float32",
+            callback=self.callback,
+        )
+        self.stream.start()
+
+    def callback(self, outdata, frames, time_info, status):
+        # Called by sounddevice on its audio thread, plays silence when idle
+
+        output = outdata[:, 0]
+        filled = 0
+
+        while filled < frames:
+
+            if (
+                self.chunk is None
+                or self.chunk_position >= len(self.chunk)
+                or self.chunk_generation != self.generation
+            ):
+                try:
+                    generation, self.chunk, prepared = self.audio.get_nowait()
+                    self.chunk_generation = generation
+                    self.chunk_position = 0
+                except queue.Empty:
+                    self.chunk = None
+                    break
+
+                if generation == self.generation and self.tts.on_sentence != None:
+                    self.tts.on_sentence(prepared)
+
+                continue
+
+            count = min(frames - filled, len(self.chunk) - self.chunk_position)
+            output[filled : filled + count] = self.chunk[
+                self.chunk_position : self.chunk_position + count
+            ]
+            self.chunk_position += count
+            filled += count
+
+        output[filled:] = 0.0
+
+    def close(self):
+
+        self.generation += 1
+        self.sentences.put((None, None, None))
+        self.thread.join()
+
+        if self.stream != None:
+            self.stream.close()
+            self.stream = None
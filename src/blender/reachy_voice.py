@@ -1,119 +1,514 @@
-import io
+import importlib
 import numpy as np
 import os
 import scipy.io.wavfile as wav
 import sounddevice as sd
 import threading
-import time
 
-from gtts import gTTS
-import pydub
-import whisper
+from .reachy_audio import read_wav, resample
+from .reachy_tts import ReachyTTS
 
+WHISPER_SAMPLERATE = 16000
+VAD_BLOCK_DURATION = 0.03  # Seconds per block of audio
 
-class ReachyVoice:
 
-    def __init__(self):
+class AudioBuffer:
+    """Growable buffer of mono float32 samples, filled by the audio callback.
+    Starts at a second of audio and doubles when full, up to max_length.
+    """
 
-        model_name = "small"
+    def __init__(self, max_length, samplerate):
 
-        print("Initiating Whisper model: '" + model_name + "'...")
-        self.model = whisper.load_model(model_name)
-        print("Whisper model ready")
+        self.max_length = max_length
+        self.samplerate = samplerate
 
-        self.recording = False
+        self.samples = np.empty(min(samplerate, max_length), dtype=np.float32)
+        self.length = 0
 
-    def record_audio(self, file_path: str, duartion_max=10.0):
+    def __len__(self):
+        return self.length
 
-        print("Recording...")
+    def append(self, samples):
+        # Returns False when max_length is reached, samples that don't fit are dropped
 
-        samplerate = 44100
-        audio_data = sd.rec(
-            int(duartion_max * samplerate),
-            samplerate=samplerate,
-            channels=1,
-            dtype="float32",
-        )
+        end = min(self.length + len(samples), self.max_length)
 
-        start_time = time.time()
+        if end > len(self.samples):
+            size = len(self.samples)
+            while size < end:
+                size = min(2 * size, self.max_length)
 
-        while self.recording:
-            # Wait until the recording is finished or stopped
+            grown = np.empty(size, dtype=np.float32)
+            grown[: self.length] = self.samples[: self.length]
+            self.samples = grown
 
-            current_time = time.time()
-            elapsed_time = current_time - start_time
+        self.samples[self.length : end] = samples[: end - self.length]
+        self.length = end
 
-            if elapsed_time >= duartion_max:
-                self.recording = False
+        return self.length < self.max_length
 
-        # Make sure recording is stopped, and data is trimmed to actual length (instead of duration_max)
-        sd.stop()
-        audio_data_trimmed = audio_data[: int(samplerate * elapsed_time)]
+    def data(self):
+        return self.samples[: self.length].copy()
 
-        # Clear file
-        open(file_path, "wb").close()
+    def slice(self, start, end):
+        # Safe while recording, length is read before the (maybe grown) samples
 
-        # Write new data
-        wav.write(file_path, samplerate, audio_data_trimmed)
-        print("Recording saved to " + str(file_path))
+        end = min(end, self.length)
+        samples = self.samples
 
-    def start_recording(self, report_blender, file_path: str, duration_max):
+        return samples[start:end].copy()
 
-        if not self.recording:
-            self.recording = True
 
-            thread = threading.Thread(
-                target=self.record_audio, args=[file_path, duration_max]
-            )
-            thread.start()
+class VoiceActivityDetector:
+    """Energy based voice activity detection, fed block by block.
+
+    A block is speech if its level is margin dB above the noise floor (and
+    above min_level). The noise floor is first the quietest block of the
+    first calibration seconds, and those blocks are only classified once it
+    is known, so speech starting right away isn't taken for noise. After
+    that it follows quieter blocks right away and louder blocks slowly.
+    With silence_duration, the utterance has ended after that many seconds
+    of silence following speech.
+    """
+
+    def __init__(self, samplerate, silence_duration=None, margin=12.0):
+
+        self.samplerate = samplerate
+        self.silence_duration = silence_duration  # Seconds, None never ends
+        self.margin = margin  # dB
+        self.min_level = -55.0  # dBFS
+        self.min_speech = 0.15  # Seconds of speech before an utterance starts
+        self.padding = 0.2  # Seconds kept around speech when trimming
+        self.calibration = 0.5  # Seconds the noise floor is first measured over
+
+        self.noise_level = None
+        self.levels = []  # (position, length, level) of blocks until calibrated
+        self.position = 0  # Samples processed
+        self.speech = 0  # Samples of speech
+        self.speech_start = None  # Sample of first and last speech
+        self.speech_end = None
+
+    def process(self, samples):
+        # Returns True when the utterance has ended
+
+        level = 10.0 * np.log10(np.mean(np.square(samples)) + 1e-12)
+
+        if self.noise_level == None:
+            # Classified once the noise floor is known
+            self.levels.append((self.position, len(samples), level))
+            self.position += len(samples)
+
+            if self.position >= self.calibration * self.samplerate:
+                self.calibrate()
 
         else:
-            report_blender({"INFO"}, "Recording is already in progress...")
+            if level < self.noise_level:
+                self.noise_level = level
+            else:
+                self.noise_level += 0.01 * (level - self.noise_level)
+
+            self.classify(self.position, len(samples), level)
+            self.position += len(samples)
+
+        if self.silence_duration == None or not self.has_speech():
+            return False
+
+        return (
+            self.position - self.speech_end >= self.silence_duration * self.samplerate
+        )
+
+    def calibrate(self):
+        # Noise floor from the quietest block so far, then classify the blocks
+
+        self.noise_level = min(level for _, _, level in self.levels)
+
+        for position, length, level in self.levels:
+            self.classify(position, length, level)
+
+        self.levels = []
+
+    def classify(self, position, length, level):
+
+        if level > max(self.noise_level + self.margin, self.min_level):
+            if self.speech_start == None:
+                self.speech_start = position
+
+            self.speech += length
+            self.speech_end = position + length
+
+    def has_speech(self):
+        return self.speech >= self.min_speech * self.samplerate
+
+    def speech_range(self):
+        # (start, end) sample of speech including padding, None if no speech
+
+        if not self.has_speech():
+            return None
+
+        padding = int(self.padding * self.samplerate)
+
+        return max(self.speech_start - padding, 0), self.speech_end + padding
+
+    def trim(self, audio):
+        # Audio without leading and trailing silence, empty if no speech
+
+        if self.noise_level == None and len(self.levels) > 0:
+            # Recording ended before calibration did
+            self.calibrate()
+
+        speech_range = self.speech_range()
+
+        if speech_range == None:
+            return audio[:0]
+
+        return audio[speech_range[0] : speech_range[1]]
+
+
+def normalize_word(word):
+    return "".join(c for c in word.lower() if c.isalnum())
+
+
+def stitch_words(words, words_new, max_overlap=8):
+    # Joins transcriptions of overlapping chunks, dropping the words of the
+    # new chunk that repeat the end of the text so far
+
+    for k in range(min(len(words), len(words_new), max_overlap), 0, -1):
+        if [normalize_word(word) for word in words[-k:]] == [
+            normalize_word(word) for word in words_new[:k]
+        ]:
+            return words + words_new[k:]
+
+    return words + words_new
+
+
+class StreamingTranscriber:
+    """Transcribes a recording in overlapping chunks while it's still being
+    recorded, so only the last chunk is left to transcribe when speech ends.
+
+    transcribe(audio) returns the text of audio at the buffer's samplerate.
+    Chunks start at the first speech found by vad, and overlap by overlap
+    seconds so words cut at a chunk boundary are heard whole in one of them.
+    """
+
+    def __init__(self, transcribe, buffer, vad, chunk_duration=4.0, overlap=1.0):
+
+        self.transcribe = transcribe
+        self.buffer = buffer
+        self.vad = vad
+
+        self.chunk_length = int(chunk_duration * buffer.samplerate)
+        self.overlap_length = int(overlap * buffer.samplerate)
+
+        self.words = []
+        self.chunk_start = None  # Sample where next chunk starts
+        self.chunks = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def text(self):
+        return " ".join(self.words)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+
+        while not self.stopped.wait(0.1):
+
+            if self.chunk_start == None:
+                speech_range = self.vad.speech_range()
+
+                if speech_range == None:
+                    continue  # No speech yet
+
+                self.chunk_start = speech_range[0]
+
+            chunk_end = self.chunk_start + self.chunk_length
+
+            if len(self.buffer) >= chunk_end:
+                self.add_chunk(self.chunk_start, chunk_end)
+                self.chunk_start = chunk_end - self.overlap_length
+
+    def add_chunk(self, start, end):
+
+        text = self.transcribe(self.buffer.slice(start, end))
+        self.words = stitch_words(self.words, text.split())
+        self.chunks += 1
+
+    def cancel(self):
+        # Stops transcribing, waits for the chunk in progress
+        self.stopped.set()
+        self.thread.join()
+
+    def finish(self):
+        # Waits for the chunk in progress, and transcribes the rest of the speech
+
+        self.stopped.set()
+        self.thread.join()
+
+        speech_range = self.vad.speech_range()
+
+        if speech_range == None:
+            return ""
+
+        start = speech_range[0] if self.chunk_start == None else self.chunk_start
+        end = min(speech_range[1], len(self.buffer))
+
+        # Only overlap left, when speech ended right at the end of a chunk
+        if end - start > self.overlap_length or self.chunks == 0:
+            self.add_chunk(start, end)
+
+        return self.text()
+
+
+class ReachyVoice:
+
+    def __init__(self, tts_directory=None):
+
+        # Synthesized speech is cached, in tts_directory between sessions
+        self.tts = ReachyTTS(directory=tts_directory)
+
+        # Whisper is slow to import and load, so it's loaded on a background
+        # thread the first time speech is used, see load_model()
+        self.model = None
+        self.model_name = None  # Name of loaded model
+        self.model_requested = None
+        self.model_status = "Not loaded"  # "Loading", "Ready" or "Failed"
+        self.model_thread = None  # Set while loading
+        self.model_lock = threading.Lock()
 
-    def stop_recording(self):
         self.recording = False
+        self.record_stream = None
+        self.record_buffer = None
+        self.record_vad = None
+        self.record_transcriber = None
+        self.transcription = None  # Of last recording, if streamed
+        self.record_file_path = None
+        self.audio = None  # Last recording, resampled for Whisper
 
-    def transcribe_audio(self, file_path: str, report_blender, language="en"):
+    def is_model_loading(self):
+        return self.model_thread != None
 
-        if os.path.exists(file_path):
-            result = self.model.transcribe(str(file_path), language=language)
-            transcription = result["text"]
+    def load_model(self, model_name="small"):
+        # Starts loading model in the background, unless loaded or loading
 
-            report_blender({"INFO"}, "Transcription: " + transcription)
+        with self.model_lock:
+            self.model_requested = model_name
 
-            return transcription
+            if self.model_thread != None:
+                return  # Worker loads the requested model before it's done
 
-        else:
-            report_blender(
-                {"ERROR"}, "File path '" + str(file_path) + "' does not exist."
+            if model_name == self.model_name:
+                return
+
+            self.model_status = "Loading"
+
+            self.model_thread = threading.Thread(
+                target=self.load_model_worker, daemon=True
             )
+            self.model_thread.start()
+
+    def load_model_worker(self):
+
+        # Model size may be changed while loading, load until up to date.
+        # The worker only finishes under the lock, so no request is missed
+        while True:
+            model_name = self.model_requested
+
+            print("Initiating Whisper model: '" + model_name + "'...")
+
+            try:
+                whisper = importlib.import_module("whisper")
+                model = whisper.load_model(model_name)
+
+            except Exception as error:
+                print("Could not load Whisper model: " + str(error))
+                model = None
+
+            with self.model_lock:
+                if model_name != self.model_requested:
+                    continue
+
+                if model != None:
+                    self.model = model
+                    self.model_name = model_name
+
+                self.model_status = "Ready" if model != None else "Failed"
+                self.model_thread = None
+
+                break
+
+        print("Whisper model " + self.model_status.lower())
+
+    def start_recording(
+        self,
+        report_blender,
+        file_path=None,
+        duration_max=10.0,
+        silence_duration=None,
+        stream_language=None,
+    ):
+        """Records from the microphone by a sounddevice callback, until
+        stop_recording(), duration_max seconds, or silence_duration seconds
+        of silence after speech. The recording is kept in self.audio, trimmed
+        to the speech, and written to file_path if given (for debugging).
+        With stream_language, speech is transcribed while it's recorded, see
+        get_transcription().
+        """
+        if self.recording:
+            report_blender({"INFO"}, "Recording is already in progress...")
+            return
 
-    def gtts_to_numpy(self, tts: gTTS):
+        self.audio = None
+        self.transcription = None
+        self.record_file_path = file_path
+
+        try:
+            # Record at Whisper's rate, so no resampling is needed
+            self.record_stream = sd.InputStream(
+                samplerate=WHISPER_SAMPLERATE,
+                blocksize=int(WHISPER_SAMPLERATE * VAD_BLOCK_DURATION),
+                channels=1,
+                dtype="float32",
+                callback=self.record_callback,
+            )
+        except sd.PortAudioError:
+            # Device doesn't support 16 kHz, record at its default rate
+            samplerate = sd.query_devices(kind="input")["default_samplerate"]
+            self.record_stream = sd.InputStream(
+                samplerate=samplerate,
+                blocksize=int(samplerate * VAD_BLOCK_DURATION),
+                channels=1,
+                dtype="float32",
+                callback=self.record_callback,
+            )
 
-        # Load into .mp3 format
-        mp3_fp = io.BytesIO()
-        tts.write_to_fp(mp3_fp)
-        mp3_fp.seek(0)  # Set buffer position at beginning
+        samplerate = int(self.record_stream.samplerate)
+        self.record_buffer = AudioBuffer(int(duration_max * samplerate), samplerate)
+        self.record_vad = VoiceActivityDetector(samplerate, silence_duration)
 
-        # Read mp3 data
-        audio = pydub.AudioSegment.from_file(mp3_fp, format="mp3")
+        self.record_transcriber = None
+        if stream_language != None and self.model_status == "Ready":
 
-        # Convert to NumPy array
-        samples = np.array(audio.get_array_of_samples())
+            def transcribe(audio):
+                audio = resample(audio, samplerate, WHISPER_SAMPLERATE)
+                return self.model.transcribe(audio, language=stream_language)["text"]
 
-        # Normalize the audio data to the range [-1, 1]
-        samples = samples / (2**15)
+            self.record_transcriber = StreamingTranscriber(
+                transcribe, self.record_buffer, self.record_vad
+            )
 
-        return samples, audio.frame_rate
+        self.recording = True
+        self.record_stream.start()
 
-    def speak_audio(self, text: str, language="en"):
+        if self.record_transcriber != None:
+            self.record_transcriber.start()
+
+        print("Recording...")
+
+    def record_callback(self, indata, frames, time_info, status):
+        # Called by sounddevice on its audio thread, for every block of samples
+
+        samples = indata[:, 0]
+
+        if not self.record_buffer.append(samples):
+            # Reached duration_max, modal operator sees it and stops
+            self.recording = False
+            raise sd.CallbackStop
 
-        if len(text) == 0:
+        if self.record_vad.process(samples):
+            # End of utterance
+            self.recording = False
+            raise sd.CallbackStop
+
+    def stop_recording(self):
+
+        self.recording = False
+
+        if self.record_stream == None:
             return
 
-        # Generate audio
-        tts = gTTS(text=text, lang=language)
+        # Returns once the last block has been passed to the callback
+        self.record_stream.stop()
+        self.record_stream.close()
+        self.record_stream = None
+
+        audio = self.record_buffer.data()
+        samplerate = self.record_buffer.samplerate
+
+        # Less audio is faster to transcribe, only keep the speech.
+        # Whisper expects mono float32 audio at 16 kHz
+        speech = self.record_vad.trim(audio)
+        self.audio = resample(speech, samplerate, WHISPER_SAMPLERATE)
+
+        if self.record_file_path:
+            wav.write(self.record_file_path, samplerate, audio)
+            print("Recording saved to " + str(self.record_file_path))
+
+        if self.record_transcriber != None:
+            self.transcription = self.record_transcriber.finish()
+            self.record_transcriber = None
+
+    def cancel_recording(self):
+        # Stops recording and discards it, without transcribing
+
+        self.recording = False
+
+        if self.record_stream != None:
+            self.record_stream.stop()
+            self.record_stream.close()
+            self.record_stream = None
+
+        if self.record_transcriber != None:
+            self.record_transcriber.cancel()
+            self.record_transcriber = None
+
+        self.audio = None
+        self.transcription = None
 
-        audio, frame_rate = self.gtts_to_numpy(tts)
+    def get_transcription(self, report_blender, language="en"):
+        # Text of the last recording, already transcribed if it was streamed
 
-        sd.play(audio, frame_rate)
+        if self.transcription == None:
+            return self.transcribe_audio(self.audio, report_blender, language)
+
+        if len(self.transcription) == 0:
+            report_blender({"ERROR"}, "No speech was recorded.")
+            return None
+
+        report_blender({"INFO"}, "Transcription: " + self.transcription)
+
+        return self.transcription
+
+    def transcribe_audio(self, audio, report_blender, language="en"):
+        # Audio is a 16 kHz float32 array, or the path of an audio file
+
+        if self.model_status != "Ready":
+            report_blender(
+                {"ERROR"}, "Whisper model is not ready: " + self.model_status
+            )
+            return None
+
+        if audio is None or len(audio) == 0:
+            report_blender({"ERROR"}, "No speech was recorded.")
+            return None
+
+        if isinstance(audio, str) and not os.path.exists(audio):
+            report_blender({"ERROR"}, "File path '" + str(audio) + "' does not exist.")
+            return None
+
+        if isinstance(audio, str) and audio.lower().endswith(".wav"):
+            # Decoded here, instead of by ffmpeg in Whisper
+            audio = read_wav(audio, WHISPER_SAMPLERATE)[0]
+
+        result = self.model.transcribe(audio, language=language)
+        transcription = result["text"]
+
+        report_blender({"INFO"}, "Transcription: " + transcription)
+
+        return transcription
+
+    def speak_audio(self, text: str, language="en"):
+        # Plays text through the speaker, without blocking
+        self.tts.speak(text, language)